@@ -0,0 +1,97 @@
+# bench_callback_dispatch.py
+"""
+Microbenchmark: callback_data dispatch cost of CallbackRouter vs the old cb_handler if/elif chain.
+
+Only the lookup is measured (handlers are not called), so the numbers show what every button
+press paid just to find its branch.
+
+    python benchmarks/bench_callback_dispatch.py [iterations]
+"""
+import os
+import sys
+import tempfile
+import timeit
+
+# keep the import side effects away from the real database / job queue
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(), "bench.db"))
+os.environ.setdefault("PROMOTION_JOB_WORKERS", "0")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import partik  # noqa: E402
+
+
+def legacy_resolve(data):
+    """
+    The comparison order and argument parsing of the if/elif chain cb_handler used before the router.
+    """
+    if data == "mat_save": return "mat_save"
+    elif data == "mat_view": return "mat_view"
+    elif data.startswith("matpg_"):
+        _, direction, mid = data.split("_", 2)
+        return "matpg_", (direction, int(mid))
+    elif data.startswith("delmat_"): return "delmat_", int(data.split("_", 1)[1])
+    elif data.startswith("sendmat_"): return "sendmat_", int(data.split("_", 1)[1])
+    elif data == "mat_clear": return "mat_clear"
+    elif data == "wallet_balance": return "wallet_balance"
+    elif data == "ref_link": return "ref_link"
+    elif data == "ref_stats": return "ref_stats"
+    elif data == "prom_show_groups": return "prom_show_groups"
+    elif data.startswith("grppg_"):
+        _, mode, gid = data.split("_", 2)
+        return "grppg_", (mode, int(gid))
+    elif data.startswith("selgroup_"):
+        parts = data.split("_")
+        return "selgroup_", (int(parts[1]), int(parts[2]) if len(parts) > 2 else None)
+    elif data.startswith("grpallq_"): return "grpallq_", int(data.split("_", 1)[1])
+    elif data.startswith("grpall_"): return "grpall_", int(data.split("_", 1)[1])
+    elif data == "grp_search": return "grp_search"
+    elif data == "grp_search_clear": return "grp_search_clear"
+    elif data == "sel_confirm": return "sel_confirm"
+    elif data == "prom_clear": return "prom_clear"
+    elif data == "prom_start": return "prom_start"
+    elif data.startswith("prompg_"):
+        _, direction, mid = data.split("_", 2)
+        return "prompg_", (direction, int(mid))
+    elif data == "prom_send_all" or data.startswith("prom_send_"):
+        return "prom_send_", None if data == "prom_send_all" else int(data.split("_", 2)[2])
+    elif data == "contact_admin": return "contact_admin"
+    elif data == "bot_status": return "bot_status"
+    elif data.startswith("plan_"): return "plan_", data.split("_", 1)[1]
+    elif data == "back_main": return "back_main"
+    return None
+
+
+# a mix weighted towards what users actually press most
+PAYLOADS = (
+    ["mat_save", "mat_view", "wallet_balance", "back_main", "prom_start"] * 2
+    + ["selgroup_-1001234567890_-1001234567000"] * 8
+    + ["grppg_n_-1001234567890", "matpg_n_120", "prompg_p_40", "sendmat_42", "delmat_42"]
+    + ["prom_send_all", "prom_send_17", "plan_1M", "contact_admin", "bot_status", "unknown_payload"]
+)
+
+
+def run(label, fn, iterations):
+    def loop():
+        for d in PAYLOADS:
+            fn(d)
+    total = min(timeit.repeat(loop, number=iterations, repeat=5))
+    per_call = total / (iterations * len(PAYLOADS)) * 1e9
+    print(f"{label:<22} {per_call:8.1f} ns/dispatch")
+    return per_call
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print(f"{len(PAYLOADS)} payloads x {iterations} iterations")
+    legacy = run("if/elif chain", legacy_resolve, iterations)
+    router = run("CallbackRouter", partik.callbacks.resolve, iterations)
+    print(f"router / chain: {router / legacy:.2f}x")
+    print("\nworst-case payloads (end of the chain):")
+    for d in ("back_main", "plan_1M", "unknown_payload"):
+        a = min(timeit.repeat(lambda: legacy_resolve(d), number=iterations * 10, repeat=5)) / (iterations * 10) * 1e9
+        b = min(timeit.repeat(lambda: partik.callbacks.resolve(d), number=iterations * 10, repeat=5)) / (iterations * 10) * 1e9
+        print(f"  {d:<18} chain {a:7.1f} ns   router {b:7.1f} ns")
+
+
+if __name__ == "__main__":
+    main()
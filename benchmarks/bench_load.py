@@ -0,0 +1,314 @@
+# bench_load.py
+"""
+Offline load test: partik's Flask webhook driven by synthetic updates, with a local fake Bot API.
+
+A stand-in HTTP server answers the Bot API methods the bot calls (sendMessage, editMessageText,
+answerCallbackQuery, getChatMember, getMe, ...). It adds FAKE_API_LATENCY_MS of delay to every
+request and answers a FAKE_API_429_RATE fraction of them with 429 and retry_after=FAKE_API_RETRY_AFTER.
+Drivers post update streams to webhook() from LOAD_DRIVER_THREADS threads. Each scenario reports:
+  - updates/sec accepted by the webhook and fully handled
+  - p50/p99 latency from POST to handler completion (queue wait + handlers)
+  - promotion completion time for the promotion scenario
+
+Scenarios:
+  start      LOAD_USERS users send /start, half of them with a referral code
+  materials  LOAD_USERS users save LOAD_MATERIALS_PER_USER texts each through the catch-all handler
+  promotion  one subscriber promotes LOAD_MESSAGES texts to LOAD_GROUPS groups
+
+    LOAD_USERS=5000 FAKE_API_LATENCY_MS=50 python benchmarks/bench_load.py [scenario ...]
+
+Send limits, worker counts and the per-user ingress limit are partik's own settings (GLOBAL_SEND_RATE,
+UPDATE_WORKERS, USER_MSG_BURST, ...); updates the ingress limiter drops are reported as throttled.
+"""
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(), "bench_load.db"))
+os.environ.setdefault("BOT_TOKEN", "123456:LOADTEST")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+LATENCY = float(os.getenv("FAKE_API_LATENCY_MS", "30")) / 1000
+RATE_429 = float(os.getenv("FAKE_API_429_RATE", "0.01"))
+RETRY_AFTER = int(os.getenv("FAKE_API_RETRY_AFTER", "1"))
+DRIVER_THREADS = int(os.getenv("LOAD_DRIVER_THREADS", "8"))
+USERS = int(os.getenv("LOAD_USERS", "2000"))
+MATERIALS_PER_USER = int(os.getenv("LOAD_MATERIALS_PER_USER", "5"))
+GROUPS = int(os.getenv("LOAD_GROUPS", "500"))
+MESSAGES = int(os.getenv("LOAD_MESSAGES", "1"))
+BOT_ID = 999000
+
+import partik  # noqa: E402
+from telebot import apihelper  # noqa: E402
+
+
+# ---------------- fake Bot API ----------------
+class FakeBotAPI(BaseHTTPRequestHandler):
+    calls = {}
+    throttled = 0
+    lock = threading.Lock()
+    message_id = 0
+
+    def log_message(self, *args):
+        pass
+
+    def _params(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length).decode() if length else ""
+        query = self.path.partition("?")[2]
+        params = {}
+        for part in filter(None, (query + "&" + body).split("&")):
+            key, _, value = part.partition("=")
+            params[key] = value
+        return params
+
+    def _reply(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self):
+        method = self.path.split("?")[0].rstrip("/").rsplit("/", 1)[-1]
+        params = self._params()
+        time.sleep(LATENCY)
+        cls = FakeBotAPI
+        with cls.lock:
+            cls.calls[method] = cls.calls.get(method, 0) + 1
+            if random.random() < RATE_429:
+                cls.throttled += 1
+                throttled = True
+            else:
+                throttled = False
+                cls.message_id += 1
+                message_id = cls.message_id
+        if throttled:
+            return self._reply(429, {"ok": False, "error_code": 429,
+                                     "description": f"Too Many Requests: retry after {RETRY_AFTER}",
+                                     "parameters": {"retry_after": RETRY_AFTER}})
+        chat_id = int(params.get("chat_id", "1") or 1)
+        if method == "getMe":
+            result = {"id": BOT_ID, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot"}
+        elif method == "getChatMember":
+            result = {"status": "administrator", "user": {"id": BOT_ID, "is_bot": True, "first_name": "LoadTest"}}
+        elif method in ("sendMessage", "editMessageText"):
+            result = {"message_id": message_id, "date": int(time.time()), "text": "",
+                      "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"}}
+        else:
+            result = True
+        self._reply(200, {"ok": True, "result": result})
+
+    do_GET = _handle
+    do_POST = _handle
+
+
+def start_fake_api():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeBotAPI)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    apihelper.API_URL = f"http://127.0.0.1:{server.server_address[1]}/bot{{0}}/{{1}}"
+    return server
+
+
+# ---------------- synthetic updates ----------------
+_update_id = 0
+_update_lock = threading.Lock()
+
+def next_update_id():
+    global _update_id
+    with _update_lock:
+        _update_id += 1
+        return _update_id
+
+def message_update(user_id, text):
+    uid = next_update_id()
+    return {"update_id": uid, "message": {
+        "message_id": uid, "date": int(time.time()), "text": text,
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}}}
+
+def callback_update(user_id, data):
+    uid = next_update_id()
+    sender = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+    return {"update_id": uid, "callback_query": {
+        "id": str(uid), "chat_instance": "1", "data": data, "from": sender,
+        "message": {"message_id": 1, "date": int(time.time()), "chat": {"id": user_id, "type": "private"}, "text": "menu"}}}
+
+
+class Tracker:
+    """
+    Records POST time per update_id and completion time when bot.process_new_updates returns.
+    Updates dropped by partik's per-user ingress limiter are answered 200 but never processed:
+    they are counted as throttled instead of being waited for.
+    """
+    def __init__(self):
+        self.posted = {}
+        self.latencies = []
+        self.rejected = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+        self.done = threading.Condition(self.lock)
+        process = partik.bot.process_new_updates
+
+        def timed_process(updates):
+            try:
+                process(updates)
+            finally:
+                now = time.perf_counter()
+                with self.lock:
+                    for u in updates:
+                        started = self.posted.pop(u.update_id, None)
+                        if started is not None:
+                            self.latencies.append(now - started)
+                    self.done.notify_all()
+        partik.bot.process_new_updates = timed_process
+        admit = partik.ingress_limiter.admit
+
+        def counted_admit(update):
+            if admit(update):
+                return True
+            with self.lock:
+                if self.posted.pop(update.update_id, None) is not None:
+                    self.throttled += 1
+                self.done.notify_all()
+            return False
+        partik.ingress_limiter.admit = counted_admit
+
+    def reset(self):
+        with self.lock:
+            self.posted.clear()
+            self.latencies = []
+            self.rejected = 0
+            self.throttled = 0
+
+    def wait_idle(self, timeout=600):
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while self.posted and time.monotonic() < deadline:
+                self.done.wait(1)
+
+
+def drive(tracker, updates):
+    """
+    Post `updates` to the webhook from DRIVER_THREADS threads; returns (accept seconds, handled seconds).
+    """
+    client = partik.app.test_client()
+    path = partik.WEBHOOK_URL_PATH
+    chunks = [updates[i::DRIVER_THREADS] for i in range(DRIVER_THREADS)]
+
+    def post(chunk):
+        for u in chunk:
+            with tracker.lock:
+                tracker.posted[u["update_id"]] = time.perf_counter()
+            resp = client.post(path, data=json.dumps(u), content_type="application/json")
+            if resp.status_code != 200:
+                with tracker.lock:
+                    tracker.posted.pop(u["update_id"], None)
+                    tracker.rejected += 1
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=post, args=(c,)) for c in chunks]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    accepted = time.perf_counter() - started
+    tracker.wait_idle()
+    return accepted, time.perf_counter() - started
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def report(name, tracker, n, accepted, handled):
+    lat = tracker.latencies
+    print(f"\n[{name}] {n:,} updates")
+    print(f"  webhook accept rate  {n / accepted:10.0f} updates/s")
+    print(f"  end-to-end rate      {len(lat) / handled:10.0f} updates/s  ({len(lat):,} handled, {tracker.rejected} rejected with 503, "
+          f"{tracker.throttled} throttled by the ingress limiter)")
+    print(f"  latency p50 / p99    {percentile(lat, 50) * 1000:8.1f} / {percentile(lat, 99) * 1000:.1f} ms")
+
+
+# ---------------- scenarios ----------------
+def scenario_start(tracker):
+    base = 1_000_000
+    referrers = [base + i for i in range(max(1, USERS // 10))]
+    updates = [message_update(r, "/start") for r in referrers]
+    updates += [message_update(base + len(referrers) + i,
+                               f"/start REF{random.choice(referrers)}" if i % 2 else "/start")
+                for i in range(USERS)]
+    tracker.reset()
+    accepted, handled = drive(tracker, updates)
+    report("mass /start with referrals", tracker, len(updates), accepted, handled)
+    credited = partik.db_fetchone("SELECT COUNT(*) FROM referrals WHERE credited=1")[0]
+    print(f"  referrals credited   {credited:,}")
+
+
+def scenario_materials(tracker):
+    base = 2_000_000
+    updates = [message_update(base + i, "/start") for i in range(USERS)]
+    drive(tracker, updates)
+    updates = [message_update(base + i, f"Promo text {k} from user {i} " * 5)
+               for k in range(MATERIALS_PER_USER) for i in range(USERS)]
+    tracker.reset()
+    accepted, handled = drive(tracker, updates)
+    report("material flood", tracker, len(updates), accepted, handled)
+
+
+def scenario_promotion(tracker):
+    uid = 3_000_000
+    drive(tracker, [message_update(uid, "/start")])
+    partik.update_user(uid, active=1, plan="Load test", plan_expiry_ts=int(time.time()) + 86400)
+    group_ids = [-(1_000_000_000 + i) for i in range(GROUPS)]
+    for gid in group_ids:
+        partik.register_group_record(gid, f"Group {gid}", partik.ADMIN_ID)
+    partik.save_selection(uid, group_ids)
+    for k in range(MESSAGES):
+        partik.save_material(uid, f"Load test promotion #{k}")
+    last_job = partik.db_fetchone("SELECT COALESCE(MAX(id), 0) FROM promotion_jobs")[0]
+
+    tracker.reset()
+    started = time.perf_counter()
+    drive(tracker, [callback_update(uid, "prom_send_all")])
+    job = None
+    while True:
+        job = partik.db_fetchone("SELECT id, status, total, sent, failed FROM promotion_jobs WHERE id>? ORDER BY id LIMIT 1",
+                                 (last_job,))
+        if job and job[1] in ("done", "failed"):
+            break
+        time.sleep(0.2)
+    elapsed = time.perf_counter() - started
+    _, status, total, sent, failed = job
+    print(f"\n[promotion] {GROUPS} groups x {MESSAGES} messages")
+    print(f"  job status           {status}: {sent}/{total} sent, {failed} failed")
+    print(f"  completion time      {elapsed:10.1f} s  ({sent / elapsed:.1f} msg/s, "
+          f"global limit {partik.GLOBAL_SEND_RATE:g} msg/s)")
+
+
+SCENARIOS = {"start": scenario_start, "materials": scenario_materials, "promotion": scenario_promotion}
+
+
+def main():
+    names = sys.argv[1:] or list(SCENARIOS)
+    start_fake_api()
+    tracker = Tracker()
+    print(f"fake Bot API: {LATENCY * 1000:.0f} ms latency, {RATE_429:.1%} 429s (retry_after={RETRY_AFTER}s); "
+          f"{partik.UPDATE_WORKERS} update workers, {DRIVER_THREADS} driver threads")
+    for name in names:
+        SCENARIOS[name](tracker)
+    print(f"\nfake Bot API calls: {dict(sorted(FakeBotAPI.calls.items()))}, 429s sent: {FakeBotAPI.throttled}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+# bench_schema_indexes.py
+"""
+Benchmark the hot read paths before and after schema migrations 1 and 5 on a seeded database.
+
+Seeds users, materials and referrals (ROWS each, default one million), then times:
+  - "before": the old query shapes (fetch all materials + len(), two referral COUNTs,
+    three separate /stats COUNTs, full material listing) without the migration's indexes
+  - "after":  count_materials / get_referral_stats / single /stats query / keyset page
+    with the indexes from migration 1 and texts moved to material_blobs by migration 5
+
+    python benchmarks/bench_schema_indexes.py [ROWS] [SAMPLES]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+DB_FILE = os.path.join(tempfile.mkdtemp(), "bench_indexes.db")
+os.environ.setdefault("DB_PATH", DB_FILE)
+os.environ.setdefault("PROMOTION_JOB_WORKERS", "0")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import partik  # noqa: E402  (creates the schema in DB_PATH)
+
+ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+SAMPLES = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+MATERIAL_OWNERS = max(1, ROWS // 50)     # ~50 materials per user
+REFERRERS = max(1, ROWS // 100)          # ~100 referrals per referrer
+
+
+def seed(conn):
+    started = time.perf_counter()
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("BEGIN")
+    conn.executemany(
+        "INSERT INTO users(user_id, username, first_name, joined, active, referral, wallet) VALUES(?,?,?,?,?,?,0)",
+        ((i, f"user{i}", "Name", "2024-01-01 00:00:00", 1 if i % 20 == 0 else 0, f"REF{i}") for i in range(1, ROWS + 1)))
+    conn.executemany(
+        "INSERT INTO materials(user_id, text_data, created_at) VALUES(?,?,?)",
+        ((random.randint(1, MATERIAL_OWNERS), "Promo text " * 20, "2024-01-01 00:00:00") for _ in range(ROWS)))
+    conn.executemany(
+        "INSERT INTO referrals(new_user_id, referrer_user_id, credited, created_at) VALUES(?,?,?,?)",
+        ((i, random.randint(1, REFERRERS), i % 3 != 0, "2024-01-01 00:00:00") for i in range(1, ROWS + 1)))
+    conn.execute("COMMIT")
+    conn.execute("ANALYZE")
+    print(f"seeded {ROWS:,} users / materials / referrals in {time.perf_counter() - started:.1f}s")
+
+
+def blob_bytes(conn):
+    return conn.execute("SELECT COALESCE(SUM(LENGTH(body)), 0) FROM material_blobs").fetchone()[0]
+
+
+def timed(label, fn, args):
+    started = time.perf_counter()
+    for a in args:
+        fn(a)
+    per_call = (time.perf_counter() - started) / len(args) * 1000
+    print(f"  {label:<34} {per_call:9.3f} ms/call")
+    return per_call
+
+
+def run_old(conn, owners, referrers):
+    def count_by_fetch(uid):
+        return len(conn.execute("SELECT id, text_data, created_at FROM materials WHERE user_id=? ORDER BY id DESC", (uid,)).fetchall())
+
+    def ref_stats_two_counts(uid):
+        conn.execute("SELECT COUNT(*) FROM referrals WHERE referrer_user_id=?", (uid,)).fetchone()
+        conn.execute("SELECT COUNT(*) FROM referrals WHERE referrer_user_id=? AND credited=1", (uid,)).fetchone()
+
+    def stats_three_counts(_):
+        conn.execute("SELECT COUNT(*) FROM users").fetchone()
+        conn.execute("SELECT COUNT(*) FROM users WHERE active=1").fetchone()
+        conn.execute("SELECT COUNT(*) FROM groups").fetchone()
+
+    def list_all(uid):
+        return conn.execute("SELECT id, text_data, created_at FROM materials WHERE user_id=? ORDER BY id DESC", (uid,)).fetchall()
+
+    return {
+        "material count": timed("materials: fetch all + len()", count_by_fetch, owners),
+        "referral stats": timed("ref_stats: two COUNTs", ref_stats_two_counts, referrers),
+        "admin stats": timed("/stats: three COUNTs", stats_three_counts, range(max(1, len(owners) // 20))),
+        "material page": timed("mat_view: full listing", list_all, owners),
+    }
+
+
+def run_new(owners, referrers):
+    stats_sql = "SELECT (SELECT COUNT(*) FROM users), (SELECT COUNT(*) FROM users WHERE active=1), (SELECT COUNT(*) FROM groups)"
+    return {
+        "material count": timed("count_materials", partik.count_materials, owners),
+        "referral stats": timed("get_referral_stats", partik.get_referral_stats, referrers),
+        "admin stats": timed("/stats: single statement", lambda _: partik.db_fetchone(stats_sql), range(max(1, len(owners) // 20))),
+        "material page": timed("get_materials_page (keyset)", partik.get_materials_page, owners),
+    }
+
+
+def main():
+    conn = partik.get_conn()
+    # start from the pre-migration schema: none of the secondary indexes the migrations add,
+    # texts inline in materials.text_data
+    for name in ("idx_materials_user", "idx_referrals_referrer", "idx_users_active", "idx_users_active_expiry",
+                 "idx_materials_blob"):
+        conn.execute(f"DROP INDEX IF EXISTS {name}")
+    seed(conn)
+
+    inline_bytes = conn.execute("SELECT COALESCE(SUM(LENGTH(CAST(text_data AS BLOB))), 0) FROM materials").fetchone()[0]
+    owners = [random.randint(1, MATERIAL_OWNERS) for _ in range(SAMPLES)]
+    referrers = [random.randint(1, REFERRERS) for _ in range(SAMPLES)]
+
+    print("\nbefore (old queries, no indexes):")
+    before = run_old(conn, owners, referrers)
+
+    started = time.perf_counter()
+    with partik.transaction() as db:
+        partik.migrate_covering_indexes(db)
+        partik.backfill_material_blobs(db)
+        db.execute("CREATE INDEX IF NOT EXISTS idx_materials_blob ON materials(blob_hash)")
+    conn.execute("ANALYZE")
+    print(f"\nmigrations 1 and 5 applied in {time.perf_counter() - started:.1f}s")
+    print(f"  material text storage: {inline_bytes / 1e3:,.0f} kB inline -> {blob_bytes(conn) / 1e3:,.1f} kB in material_blobs")
+
+    print("\nafter (aggregate queries, covering indexes, content-addressed texts):")
+    after = run_new(owners, referrers)
+
+    print("\nspeedup:")
+    for key in before:
+        print(f"  {key:<16} {before[key] / after[key]:10.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,12 @@
+# gunicorn.conf.py
+"""
+gunicorn settings for partik's Flask webhook, read from the working directory:
+
+    gunicorn partik:app --preload -w 2
+"""
+
+
+def post_fork(server, worker):
+    # partik's background threads are per process: start them in each worker, never in the --preload master
+    import partik
+    partik.start_background_workers()
@@ -1,14 +1,39 @@
 # systematic_bot.py
 import telebot
-from telebot import types
+import requests
+from requests.adapters import HTTPAdapter
+from telebot import types, apihelper
 import sqlite3
 from datetime import datetime, timedelta
 import time
 import threading
+import asyncio
+import functools
+import heapq
+import bisect
+import sys
+import json
+import hashlib
+import zlib
+import random
+import queue
+from collections import OrderedDict, deque
 import logging
 import re
+import html
 import os
+import socket
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, request, abort
+try:
+    from aiohttp import web
+    from telebot import asyncio_helper
+    from telebot.async_telebot import AsyncTeleBot
+except ImportError:  # aiohttp is only needed for ASYNC_MODE
+    web = asyncio_helper = AsyncTeleBot = None
+
+BOOT_STARTED = time.perf_counter()  # startup time is logged once the webhook is ready
 
 # ---------------- CONFIG ----------------
 BOT_TOKEN = os.getenv("BOT_TOKEN", "8213222692:AAGQPfCzQpCKspfHy9SKd8zsWFxuZlvAYKA")
@@ -28,80 +53,879 @@ else:
 
 WEBHOOK_URL_PATH = f"/{BOT_TOKEN}/"
 WEBHOOK_URL = WEBHOOK_HOST + WEBHOOK_URL_PATH
-
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "0"))  # concurrent webhook POSTs, 0 = from worker count
+
+# Outbound send limits (Telegram: ~30 msg/s overall, ~20 msg/min inside one group)
+GLOBAL_SEND_RATE = float(os.getenv("GLOBAL_SEND_RATE", "25"))        # messages per second, all chats
+GLOBAL_SEND_BURST = int(os.getenv("GLOBAL_SEND_BURST", "25"))
+PER_CHAT_SEND_RATE = float(os.getenv("PER_CHAT_SEND_RATE", str(20 / 60)))  # messages per second, one chat
+PER_CHAT_SEND_BURST = int(os.getenv("PER_CHAT_SEND_BURST", "3"))
+CHAT_LIMITER_SIZE = int(os.getenv("CHAT_LIMITER_SIZE", "10000"))      # per-chat buckets kept, least recently used dropped
+PROMOTION_WORKERS = int(os.getenv("PROMOTION_WORKERS", "8"))
+PROGRESS_INTERVAL = float(os.getenv("PROGRESS_INTERVAL", "5"))       # seconds between progress edits
+PROMOTION_JOB_WORKERS = int(os.getenv("PROMOTION_JOB_WORKERS", "2"))  # promotion jobs running at once
+ADMIN_CACHE_TTL = float(os.getenv("ADMIN_CACHE_TTL", "600"))         # seconds an admin-status lookup stays valid
+ADMIN_CACHE_SIZE = int(os.getenv("ADMIN_CACHE_SIZE", "5000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))           # bounds staleness if another process writes users
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_SYNC = float(os.getenv("USER_CACHE_SYNC", "1"))            # seconds between checks for users writes by other processes
+SENDER_LEASE_TTL = int(os.getenv("SENDER_LEASE_TTL", "30"))            # one process runs the background senders; taken over after this
+EXPIRY_SWEEP_INTERVAL = float(os.getenv("EXPIRY_SWEEP_INTERVAL", "60"))  # seconds between subscription expiry sweeps
+EXPIRY_BATCH_SIZE = int(os.getenv("EXPIRY_BATCH_SIZE", "500"))
+EXPIRY_REMINDER_DAYS = int(os.getenv("EXPIRY_REMINDER_DAYS", "3"))      # 0 disables "plan expiring" reminders
+SCHEDULE_MIN_HOURS = float(os.getenv("SCHEDULE_MIN_HOURS", "1"))        # shortest allowed repeat interval
+SCHEDULE_SPREAD = int(os.getenv("SCHEDULE_SPREAD", "300"))              # seconds over which start times are spread
+API_POOL_SIZE = int(os.getenv("API_POOL_SIZE", "32"))                 # keep-alive connections to the Bot API, shared by all threads
+API_MAX_RETRIES = int(os.getenv("API_MAX_RETRIES", "3"))              # retries for 429 / 5xx / connection errors
+API_RETRY_BASE = float(os.getenv("API_RETRY_BASE", "0.5"))            # seconds; 5xx backoff is random(0, base * 2^attempt)
+API_RETRY_MAX_WAIT = float(os.getenv("API_RETRY_MAX_WAIT", "5"))      # longer 429 retry_after waits go back to the caller
+CHAT_BREAKER_COOLDOWN = float(os.getenv("CHAT_BREAKER_COOLDOWN", "600"))  # seconds a chat that answered 403 is not called
+CHAT_BREAKER_MAX_COOLDOWN = float(os.getenv("CHAT_BREAKER_MAX_COOLDOWN", "86400"))
+CHAT_BREAKER_SIZE = int(os.getenv("CHAT_BREAKER_SIZE", "100000"))
+GROUP_SWEEP_INTERVAL = float(os.getenv("GROUP_SWEEP_INTERVAL", "21600"))  # seconds between group health sweeps
+GROUP_SWEEP_RATE = float(os.getenv("GROUP_SWEEP_RATE", "5"))          # getChatMember checks per second while sweeping
+GROUP_SWEEP_BATCH = int(os.getenv("GROUP_SWEEP_BATCH", "100"))        # groups checked per write transaction
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", "100"))             # users per keyset page; progress is saved after each
+GROUP_PRUNE_AFTER = float(os.getenv("GROUP_PRUNE_AFTER", str(7 * 86400)))  # dead groups are deleted after this many seconds
+USER_MSG_RATE = float(os.getenv("USER_MSG_RATE", "1"))                # messages per second one user may send us
+USER_MSG_BURST = int(os.getenv("USER_MSG_BURST", "10"))
+USER_LIMITER_SIZE = int(os.getenv("USER_LIMITER_SIZE", "50000"))      # users with a live bucket; least recent dropped
+MATERIAL_QUOTA = int(os.getenv("MATERIAL_QUOTA", "200"))               # saved texts per user, 0 = unlimited
+STEP_STORE = os.getenv("STEP_STORE", "sqlite")                         # "sqlite" (shared by worker processes) or "memory"
+STEP_TTL = int(os.getenv("STEP_TTL", "900"))                           # seconds a "send me the text" prompt stays answerable
+JOB_LEASE_TTL = int(os.getenv("JOB_LEASE_TTL", "60"))                  # a promotion job whose worker stops renewing is taken over
+ASYNC_MODE = os.getenv("ASYNC_MODE", "0") == "1"                      # aiohttp webhook + asyncio promotion sends (needs aiohttp); handlers stay threaded
+ASYNC_DB_WORKERS = int(os.getenv("ASYNC_DB_WORKERS", "8"))            # executor threads for SQLite and other blocking calls
+ASYNC_SEND_CONCURRENCY = int(os.getenv("ASYNC_SEND_CONCURRENCY", "200"))  # Bot API calls in flight on the event loop
+MATERIAL_BODY_CACHE_SIZE = int(os.getenv("MATERIAL_BODY_CACHE_SIZE", "2000"))  # decompressed material texts kept in memory
+MATERIALS_PAGE_SIZE = int(os.getenv("MATERIALS_PAGE_SIZE", "5"))
+GROUPS_PAGE_SIZE = int(os.getenv("GROUPS_PAGE_SIZE", "8"))
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "4"))              # threads running handlers for webhook updates
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))     # per worker; webhook answers 503 when full
+UPDATE_DEDUP_WINDOW = int(os.getenv("UPDATE_DEDUP_WINDOW", "10000"))  # recent update_ids remembered in memory
+UPDATE_DEDUP_PERSIST = os.getenv("UPDATE_DEDUP_PERSIST", "1") == "1"  # keep the highest update_id in SQLite across restarts
+UPDATE_DEDUP_FLUSH = float(os.getenv("UPDATE_DEDUP_FLUSH", "5"))        # seconds between writes of the stored update_id
+UPDATE_ID_RESET_AGE = float(os.getenv("UPDATE_ID_RESET_AGE", str(6 * 86400)))  # stored update_id ignored after this long
+
+# threaded=False: handlers run on our update workers (see UPDATE QUEUE), which keep per-chat order
+bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML", threaded=False)
 app = Flask(__name__)
 
 # ---------------- LOGGING ----------------
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
+# ---------------- METRICS ----------------
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # seconds
+
+class Metrics:
+    """
+    Thread-safe counters and latency histograms, exposed in the Prometheus text format on /metrics.
+    Series are keyed by (name, labels) where labels is a tuple of (key, value) pairs; an
+    observation costs one lock, a dict lookup and a bisect, so it can stay on in production.
+    """
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}   # (name, labels) -> [per-bucket counts..., +Inf count, sum]
+        self.help = {}
+        self.gauges = {}       # name -> function returning {labels: value}, called on scrape
+
+    def describe(self, name, kind, text):
+        self.help[name] = (kind, text)
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, seconds):
+        i = bisect.bisect_left(self.buckets, seconds)
+        key = (name, labels)
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [0] * (len(self.buckets) + 2)
+            h[i] += 1
+            h[-1] += seconds
+
+    def gauge(self, name, text, fn, kind="gauge"):
+        """
+        A series computed on scrape from state kept elsewhere (queue depth, cache hit counts).
+        """
+        self.describe(name, kind, text)
+        self.gauges[name] = fn
+
+    @contextmanager
+    def timer(self, name, labels=(), errors=None):
+        """
+        Observe the block's duration in histogram `name`; count exceptions in counter `errors`.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            if errors:
+                self.inc(errors, labels)
+            raise
+        finally:
+            self.observe(name, labels, time.perf_counter() - started)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = tuple(labels) + tuple(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                              for k, v in pairs) + "}"
+
+    def render(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((k, list(v)) for k, v in self.histograms.items())
+        families = {}
+        for (name, labels), value in counters:
+            families.setdefault(name, []).append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), h in histograms:
+            lines = families.setdefault(name, [])
+            cumulative = 0
+            for bound, n in zip(self.buckets + ("+Inf",), h[:-1]):
+                cumulative += n
+                lines.append(f"{name}_bucket{self._labels(labels, (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{self._labels(labels)} {h[-1]:.6f}")
+            lines.append(f"{name}_count{self._labels(labels)} {cumulative}")
+        for name, fn in self.gauges.items():
+            try:
+                values = fn()
+            except Exception as e:
+                logging.warning("gauge %s failed: %s", name, e)
+                continue
+            families[name] = [f"{name}{self._labels(labels)} {value}" for labels, value in values.items()]
+        out = []
+        for name in sorted(families):
+            kind, text = self.help.get(name, ("untyped", name))
+            out.append(f"# HELP {name} {text}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(families[name])
+        return "\n".join(out) + "\n"
+
+
+metrics = Metrics()
+metrics.describe("bot_handler_seconds", "histogram", "Time spent in message, callback and chat member handlers")
+metrics.describe("bot_handler_errors_total", "counter", "Handler calls that raised")
+metrics.describe("telegram_api_seconds", "histogram", "Outbound Bot API request latency by method")
+metrics.describe("telegram_api_errors_total", "counter", "Failed Bot API requests by method and error code")
+metrics.describe("telegram_api_retries_total", "counter", "Bot API requests retried after 429, 5xx or a connection error")
+metrics.describe("db_query_seconds", "histogram", "SQLite statement time by calling helper")
+metrics.describe("db_transaction_seconds", "histogram", "SQLite transaction time (lock wait included) by calling helper")
+metrics.describe("promotion_messages_total", "counter", "Promotion deliveries by outcome")
+metrics.describe("broadcast_messages_total", "counter", "Admin broadcast deliveries by outcome")
+metrics.describe("promotion_group_failures_total", "counter", "Failed or skipped promotion deliveries per group")
+metrics.describe("promotion_jobs_total", "counter", "Finished promotion jobs by status")
+metrics.describe("webhook_request_seconds", "histogram", "Time to accept a webhook update (parse, dedup, enqueue)")
+metrics.describe("ingress_throttled_total", "counter", "Incoming messages dropped by the per-user ingress limiter")
+metrics.describe("material_quota_rejections_total", "counter", "Texts not saved because the user reached MATERIAL_QUOTA")
+metrics.describe("update_queue_lag_seconds", "histogram", "Time an update waited in the queue before its handlers ran")
+
+def _timed_handler(kind, func):
+    labels = (("kind", kind), ("handler", func.__name__))
+    def wrapper(*args, **kwargs):
+        with metrics.timer("bot_handler_seconds", labels, errors="bot_handler_errors_total"):
+            return func(*args, **kwargs)
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+def instrument_handlers():
+    """
+    Time every registered message and chat member handler. Callback queries are timed per route
+    by CallbackRouter.dispatch instead of as the single catch-all cb_handler.
+    """
+    for kind, handlers in (("message", bot.message_handlers), ("my_chat_member", bot.my_chat_member_handlers)):
+        for h in handlers:
+            h['function'] = _timed_handler(kind, h['function'])
+
+# ---------------- BOT API CLIENT ----------------
+class ChatUnavailable(apihelper.ApiTelegramException):
+    """
+    Raised without calling Telegram while a chat's circuit is open (it answered 403 recently).
+    """
+    def __init__(self, method_name, chat_id):
+        super().__init__(method_name, None, {'error_code': 403, 'description': f"Forbidden: chat {chat_id} unavailable (circuit open)"})
+        self.chat_id = chat_id
+
+
+class ChatCircuitBreaker:
+    """
+    Chats that answer 403 (bot blocked, kicked, no rights) are not called for `cooldown` seconds.
+    Then a single probe call goes through: success closes the circuit, another 403 doubles the
+    cooldown (up to `max_cooldown`). At most `maxsize` chats are tracked, oldest dropped first.
+    Chat ids are keyed as strings: that is how telebot puts them in request params.
+    """
+    def __init__(self, cooldown, max_cooldown, maxsize):
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.maxsize = maxsize
+        self.open = OrderedDict()   # chat_id -> (closed again at, current cooldown)
+        self.lock = threading.Lock()
+
+    def allow(self, chat_id):
+        if not self.open:
+            return True
+        with self.lock:
+            chat_id = str(chat_id)
+            entry = self.open.get(chat_id)
+            if entry is None:
+                return True
+            until, cooldown = entry
+            now = time.monotonic()
+            if now < until:
+                return False
+            # half-open: this caller probes, everyone else waits another cooldown
+            self.open[chat_id] = (now + cooldown, cooldown)
+            return True
+
+    def trip(self, chat_id):
+        chat_id = str(chat_id)
+        with self.lock:
+            entry = self.open.pop(chat_id, None)
+            cooldown = min(entry[1] * 2, self.max_cooldown) if entry else self.cooldown
+            self.open[chat_id] = (time.monotonic() + cooldown, cooldown)
+            while len(self.open) > self.maxsize:
+                self.open.popitem(last=False)
+
+    def reset(self, chat_id):
+        if self.open:
+            with self.lock:
+                self.open.pop(str(chat_id), None)
+
+    def __len__(self):
+        return len(self.open)
+
+
+chat_breaker = ChatCircuitBreaker(CHAT_BREAKER_COOLDOWN, CHAT_BREAKER_MAX_COOLDOWN, CHAT_BREAKER_SIZE)
+
+# one keep-alive pool shared by every thread (telebot's default is a session per thread, so each
+# short-lived promotion worker paid a fresh TCP + TLS handshake); pool_block caps open connections
+_api_session = requests.Session()
+_api_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=API_POOL_SIZE, pool_block=True)
+_api_session.mount("https://", _api_adapter)
+_api_session.mount("http://", _api_adapter)
+
+def _send_api_request(method, url, **kwargs):
+    return _api_session.request(method, url, **kwargs)
+
+apihelper.CUSTOM_REQUEST_SENDER = _send_api_request
+
+def api_error_code(e):
+    """
+    Telegram's error code, the HTTP status if the answer was not JSON, or "network" if there was no answer.
+    Works for the exceptions of both apihelper and asyncio_helper.
+    """
+    code = getattr(e, "error_code", None)
+    if code is None:
+        result = getattr(e, "result", None)
+        code = getattr(result, "status_code", None) or getattr(result, "status", None)
+    return "network" if code is None else code
+
+def retry_after(e):
+    """
+    Seconds Telegram asked us to wait in a 429 answer.
+    """
+    params = (getattr(e, "result_json", None) or {}).get("parameters") or {}
+    return params.get("retry_after", 1)
+
+def api_retry_delay(e, attempt):
+    """
+    Seconds to wait before retrying a failed call, or None to give up: 429 waits what Telegram asks
+    for (at most API_RETRY_MAX_WAIT), 5xx and connection errors back off exponentially with full jitter.
+    """
+    if attempt >= API_MAX_RETRIES:
+        return None
+    code = api_error_code(e)
+    if code == 429:
+        wait = retry_after(e)
+        return wait if wait <= API_RETRY_MAX_WAIT else None
+    if code == "network" or (isinstance(code, int) and code >= 500):
+        return random.uniform(0, API_RETRY_BASE * 2 ** attempt)
+    return None
+
+_api_make_request = apihelper._make_request
+
+def _api_request(token, method_name, method='get', params=None, files=None):
+    """
+    Every Bot API call (send_message, get_chat_member, get_me, ...) goes through apihelper._make_request:
+    timed per method, retried on 429 / 5xx / connection errors, short-circuited for chats behind an open breaker.
+    """
+    chat_id = params.get("chat_id") if params else None
+    labels = (("method", method_name),)
+    if chat_id is not None and not chat_breaker.allow(chat_id):
+        metrics.inc("telegram_api_errors_total", labels + (("code", "circuit_open"),))
+        raise ChatUnavailable(method_name, chat_id)
+    attempt = 0
+    while True:
+        started = time.perf_counter()
+        try:
+            # _make_request pops keys from params, so every attempt gets its own copy
+            result = _api_make_request(token, method_name, method, params=dict(params) if params else params, files=files)
+        except (apihelper.ApiException, requests.ConnectionError) as e:
+            code = api_error_code(e)
+            metrics.inc("telegram_api_errors_total", labels + (("code", code),))
+            if code == 403 and chat_id is not None:
+                chat_breaker.trip(chat_id)
+            # uploads are not retried: their file objects were consumed by the first attempt
+            wait = None if files else api_retry_delay(e, attempt)
+            if wait is None:
+                raise
+            error = e
+        else:
+            if chat_id is not None:
+                chat_breaker.reset(chat_id)
+            return result
+        finally:
+            metrics.observe("telegram_api_seconds", labels, time.perf_counter() - started)
+        attempt += 1
+        metrics.inc("telegram_api_retries_total", labels)
+        logging.debug("retrying %s in %.2fs (attempt %s): %s", method_name, wait, attempt, error)
+        time.sleep(wait)
+
+apihelper._make_request = _api_request
+
 # ---------------- DATABASE ----------------
-conn = sqlite3.connect("systematic_promo.db", check_same_thread=False)
-cur = conn.cursor()
-
-# Users table
-cur.execute("""
-CREATE TABLE IF NOT EXISTS users (
-    user_id INTEGER PRIMARY KEY,
-    username TEXT,
-    first_name TEXT,
-    joined TEXT,
-    active INTEGER DEFAULT 0,
-    plan TEXT DEFAULT '',
-    plan_expiry TEXT DEFAULT '',
-    referral TEXT,
-    wallet INTEGER DEFAULT 0,
-    referred_by INTEGER DEFAULT NULL
-)
-""")
-
-# Saved materials
-cur.execute("""
-CREATE TABLE IF NOT EXISTS materials (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    text_data TEXT,
-    created_at TEXT
-)
-""")
-
-# Registered groups where bot is admin (chat_id unique)
-cur.execute("""
-CREATE TABLE IF NOT EXISTS groups (
-    chat_id INTEGER PRIMARY KEY,
-    title TEXT,
-    registered_by INTEGER,
-    registered_at TEXT
-)
-""")
-
-# referrals (to ensure one-time credit)
-cur.execute("""
-CREATE TABLE IF NOT EXISTS referrals (
-    new_user_id INTEGER PRIMARY KEY,
-    referrer_user_id INTEGER,
-    credited INTEGER DEFAULT 0,
-    created_at TEXT
-)
-""")
-
-# saved selections per user (selected groups for promotion)
-cur.execute("""
-CREATE TABLE IF NOT EXISTS selections (
-    user_id INTEGER PRIMARY KEY,
-    group_ids TEXT  -- comma separated
-)
-""")
-
-conn.commit()
+DB_PATH = os.getenv("DB_PATH", "systematic_promo.db")
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", "10"))  # seconds to wait on a locked database
+
+_db_local = threading.local()
+
+def get_conn():
+    """
+    Connection owned by the calling thread (created on first use).
+    Autocommit mode: single statements commit on their own, use transaction() to group writes.
+    """
+    c = getattr(_db_local, "conn", None)
+    if c is not None and _db_local.pid != os.getpid():
+        # opened before fork() (gunicorn --preload): never use it in the child, SQLite connections don't survive fork
+        c = None
+    if c is None:
+        c = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT, isolation_level=None)
+        c.execute("PRAGMA journal_mode=WAL")
+        c.execute("PRAGMA synchronous=NORMAL")
+        c.execute(f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT * 1000)}")
+        c.execute("PRAGMA foreign_keys=ON")
+        _db_local.conn = c
+        _db_local.pid = os.getpid()
+        _db_local.depth = 0
+    return c
+
+def in_transaction():
+    return bool(getattr(_db_local, "depth", 0))
+
+@contextmanager
+def transaction():
+    """
+    BEGIN IMMEDIATE ... COMMIT on this thread's connection, rolled back on error.
+    Nested use joins the outer transaction.
+    """
+    c = get_conn()
+    if _db_local.depth:
+        _db_local.depth += 1
+        try:
+            yield c
+        finally:
+            _db_local.depth -= 1
+        return
+    # frame 1 is contextlib's __enter__, frame 2 the function that opened the transaction
+    labels = (("caller", sys._getframe(2).f_code.co_name),)
+    started = time.perf_counter()
+    c.execute("BEGIN IMMEDIATE")
+    _db_local.depth = 1
+    _db_local.after_commit = []
+    try:
+        yield c
+        c.execute("COMMIT")
+    except BaseException:
+        if c.in_transaction:
+            c.execute("ROLLBACK")
+        raise
+    finally:
+        _db_local.depth = 0
+        callbacks, _db_local.after_commit = _db_local.after_commit, []
+        metrics.observe("db_transaction_seconds", labels, time.perf_counter() - started)
+    for fn in callbacks:
+        fn()
+
+def on_commit(fn):
+    """
+    Run fn() once the current transaction has committed (right away outside one; never after a rollback).
+    """
+    if in_transaction():
+        _db_local.after_commit.append(fn)
+    else:
+        fn()
+
+def _timed_query(op, sql, params):
+    started = time.perf_counter()
+    try:
+        cur = get_conn().execute(sql, params)
+        if op == "fetchone":
+            return cur.fetchone()
+        if op == "fetchall":
+            return cur.fetchall()
+        return cur
+    finally:
+        # frame 2 is the helper that called db_execute / db_fetchone / db_fetchall
+        metrics.observe("db_query_seconds", (("helper", sys._getframe(2).f_code.co_name), ("op", op)),
+                        time.perf_counter() - started)
+
+def db_execute(sql, params=()):
+    return _timed_query("execute", sql, params)
+
+def db_fetchone(sql, params=()):
+    return _timed_query("fetchone", sql, params)
+
+def db_fetchall(sql, params=()):
+    return _timed_query("fetchall", sql, params)
+
+def migrate_legacy_selections(db):
+    """
+    Move rows from the old comma-separated `selections` table into user_group_selection.
+    Ids of groups that are no longer registered are dropped.
+    """
+    if not db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='selections'").fetchone():
+        return
+    rows = db.execute("SELECT user_id, group_ids FROM selections").fetchall()
+    pairs = []
+    for user_id, gid_str in rows:
+        pairs.extend((user_id, int(x)) for x in (gid_str or "").split(",") if x.strip())
+    db.executemany("INSERT OR IGNORE INTO user_group_selection(user_id, chat_id) SELECT ?, chat_id FROM groups WHERE chat_id=?", pairs)
+    db.execute("DROP TABLE selections")
+    logging.info("Migrated group selections of %s users to user_group_selection", len(rows))
+
+GROUPS_FTS = True
+
+def init_groups_fts(db):
+    """
+    External-content FTS5 table over groups.title, kept in sync by triggers.
+    Falls back to LIKE search when SQLite is built without FTS5.
+    """
+    global GROUPS_FTS
+    exists = db.execute("SELECT 1 FROM sqlite_master WHERE name='groups_fts'").fetchone()
+    try:
+        db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS groups_fts USING fts5(title, content='groups', content_rowid='chat_id')")
+    except sqlite3.OperationalError as e:
+        logging.warning("FTS5 not available, group search falls back to LIKE: %s", e)
+        GROUPS_FTS = False
+        return
+    db.execute("""
+    CREATE TRIGGER IF NOT EXISTS groups_fts_ai AFTER INSERT ON groups BEGIN
+        INSERT INTO groups_fts(rowid, title) VALUES (new.chat_id, new.title);
+    END
+    """)
+    db.execute("""
+    CREATE TRIGGER IF NOT EXISTS groups_fts_ad AFTER DELETE ON groups BEGIN
+        INSERT INTO groups_fts(groups_fts, rowid, title) VALUES ('delete', old.chat_id, old.title);
+    END
+    """)
+    db.execute("""
+    CREATE TRIGGER IF NOT EXISTS groups_fts_au AFTER UPDATE OF title ON groups BEGIN
+        INSERT INTO groups_fts(groups_fts, rowid, title) VALUES ('delete', old.chat_id, old.title);
+        INSERT INTO groups_fts(rowid, title) VALUES (new.chat_id, new.title);
+    END
+    """)
+    if not exists:
+        db.execute("INSERT INTO groups_fts(groups_fts) VALUES ('rebuild')")
+
+# ---------------- SCHEMA MIGRATIONS ----------------
+def create_base_schema(db):
+    """
+    Tables from before schema versioning. Applied when user_version is 0 (new database, or one created
+    before migrations existed); every statement is IF NOT EXISTS, so legacy databases keep their data.
+    """
+    # Users table
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        joined TEXT,
+        active INTEGER DEFAULT 0,
+        plan TEXT DEFAULT '',
+        plan_expiry TEXT DEFAULT '',
+        referral TEXT,
+        wallet INTEGER DEFAULT 0,
+        referred_by INTEGER DEFAULT NULL
+    )
+    """)
+
+    # Saved materials
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS materials (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        text_data TEXT,
+        created_at TEXT
+    )
+    """)
+
+    # Registered groups where bot is admin (chat_id unique)
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS groups (
+        chat_id INTEGER PRIMARY KEY,
+        title TEXT,
+        registered_by INTEGER,
+        registered_at TEXT
+    )
+    """)
+
+    # referrals (to ensure one-time credit)
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS referrals (
+        new_user_id INTEGER PRIMARY KEY,
+        referrer_user_id INTEGER,
+        credited INTEGER DEFAULT 0,
+        created_at TEXT
+    )
+    """)
+
+    # selected groups per user for promotion (one row per selected group)
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS user_group_selection (
+        user_id INTEGER,
+        chat_id INTEGER REFERENCES groups(chat_id) ON DELETE CASCADE,
+        PRIMARY KEY (user_id, chat_id)
+    ) WITHOUT ROWID
+    """)
+    db.execute("CREATE INDEX IF NOT EXISTS idx_user_group_selection_chat ON user_group_selection(chat_id)")
+    migrate_legacy_selections(db)
+
+    # group picker: keyset paging by title and an FTS5 index for title search
+    db.execute("CREATE INDEX IF NOT EXISTS idx_groups_title ON groups(title, chat_id)")
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS group_search (
+        user_id INTEGER PRIMARY KEY,
+        query TEXT
+    )
+    """)
+    init_groups_fts(db)
+
+    # wallet ledger: every balance change, idempotency_key guards against double credits
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS wallet_transactions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        amount INTEGER,
+        reason TEXT,
+        idempotency_key TEXT UNIQUE,
+        created_at TEXT
+    )
+    """)
+    db.execute("CREATE INDEX IF NOT EXISTS idx_wallet_transactions_user ON wallet_transactions(user_id, id)")
+
+    # small key/value store for process-wide state (e.g. last seen update_id)
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS bot_state (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )
+    """)
+
+    # persisted promotion jobs (survive restarts / redeploys)
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS promotion_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        group_ids TEXT,  -- comma separated
+        messages TEXT,   -- JSON list of texts
+        status TEXT DEFAULT 'queued',  -- queued, running, done, failed, cancelled (plan lapsed)
+        total INTEGER DEFAULT 0,
+        sent INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        created_at TEXT,
+        started_at TEXT,
+        finished_at TEXT
+    )
+    """)
+
+    # one row per (job, group, message) checkpoint
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS promotion_deliveries (
+        job_id INTEGER,
+        chat_id INTEGER,
+        msg_index INTEGER,
+        status TEXT,  -- pending, sent, failed, skipped
+        updated_at TEXT,
+        PRIMARY KEY (job_id, chat_id, msg_index)
+    )
+    """)
+
+def migrate_covering_indexes(db):
+    # materials by owner (listing, paging, counting), referral stats, active-user counts
+    db.execute("CREATE INDEX IF NOT EXISTS idx_materials_user ON materials(user_id, id)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals(referrer_user_id, credited)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_users_active ON users(active)")
+
+def migrate_plan_expiry_epoch(db):
+    # integer expiry for index range scans; plan_expiry stays as the human-readable copy
+    db.execute("ALTER TABLE users ADD COLUMN plan_expiry_ts INTEGER")
+    db.execute("ALTER TABLE users ADD COLUMN expiry_reminded INTEGER DEFAULT 0")
+    db.execute("UPDATE users SET plan_expiry_ts = CAST(strftime('%s', plan_expiry) AS INTEGER) WHERE plan_expiry != ''")
+    # (active, plan_expiry_ts) serves the sweep's range scan and active-user counts alike
+    db.execute("CREATE INDEX IF NOT EXISTS idx_users_active_expiry ON users(active, plan_expiry_ts)")
+    db.execute("DROP INDEX IF EXISTS idx_users_active")
+
+def migrate_scheduled_promotions(db):
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS scheduled_promotions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        material_id INTEGER,  -- NULL = all saved materials
+        interval_seconds INTEGER,
+        next_run_ts INTEGER,
+        last_run_ts INTEGER,
+        active INTEGER DEFAULT 1,
+        created_at TEXT
+    )
+    """)
+    db.execute("CREATE INDEX IF NOT EXISTS idx_scheduled_promotions_due ON scheduled_promotions(active, next_run_ts)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_scheduled_promotions_user ON scheduled_promotions(user_id)")
+
+def migrate_group_health(db):
+    # status: 'ok' (bot is admin), 'not_admin' or 'dead' (bot kicked / chat gone); status_since drives pruning
+    db.execute("ALTER TABLE groups ADD COLUMN status TEXT DEFAULT 'ok'")
+    db.execute("ALTER TABLE groups ADD COLUMN status_since INTEGER")
+    db.execute("ALTER TABLE groups ADD COLUMN last_verified_at INTEGER")
+
+def material_blob(text):
+    """
+    (hash, compressed body, size) row for material_blobs.
+    """
+    raw = text.encode("utf-8")
+    return hashlib.sha256(raw).digest(), zlib.compress(raw), len(raw)
+
+def backfill_material_blobs(db, chunk=1000):
+    """
+    Move inline materials.text_data into material_blobs, chunked by id so the scan never reads rows it is rewriting.
+    """
+    last = 0
+    while True:
+        rows = db.execute("SELECT id, text_data FROM materials WHERE id > ? AND text_data IS NOT NULL ORDER BY id LIMIT ?",
+                          (last, chunk)).fetchall()
+        if not rows:
+            return
+        last = rows[-1][0]
+        blobs = [material_blob(text) for _, text in rows]
+        db.executemany("INSERT OR IGNORE INTO material_blobs(hash, body, size) VALUES(?,?,?)", blobs)
+        db.executemany("UPDATE materials SET blob_hash=?, text_data=NULL WHERE id=?",
+                       [(b[0], mid) for b, (mid, _) in zip(blobs, rows)])
+
+def migrate_material_blobs(db):
+    # one compressed copy per distinct text; materials rows become per-user references (ids unchanged)
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS material_blobs (
+        hash BLOB PRIMARY KEY,  -- SHA-256 of the UTF-8 text
+        body BLOB,              -- zlib-compressed text
+        size INTEGER            -- uncompressed bytes
+    ) WITHOUT ROWID
+    """)
+    db.execute("ALTER TABLE materials ADD COLUMN blob_hash BLOB")
+    backfill_material_blobs(db)
+    db.execute("CREATE INDEX IF NOT EXISTS idx_materials_blob ON materials(blob_hash)")
+
+def migrate_conversation_steps(db):
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS conversation_steps (
+        chat_id INTEGER,
+        user_id INTEGER,
+        step TEXT,
+        args TEXT,  -- JSON list passed to the step handler
+        expires_at INTEGER,
+        PRIMARY KEY (chat_id, user_id)
+    ) WITHOUT ROWID
+    """)
+
+def migrate_promotion_job_leases(db):
+    # the worker process running a job renews lease_expires; an expired lease lets another process resume it
+    db.execute("ALTER TABLE promotion_jobs ADD COLUMN lease_owner TEXT")
+    db.execute("ALTER TABLE promotion_jobs ADD COLUMN lease_expires INTEGER")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_promotion_jobs_status ON promotion_jobs(status, id)")
+
+def migrate_broadcasts(db):
+    # blocked_at: the user blocked the bot (403 or my_chat_member "kicked"); broadcasts skip them until they unblock
+    db.execute("ALTER TABLE users ADD COLUMN blocked_at INTEGER")
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT,
+        status TEXT DEFAULT 'queued',  -- queued, running, done, cancelled
+        cursor INTEGER DEFAULT 0,      -- last user_id handled; a resumed broadcast continues after it
+        sent INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        blocked INTEGER DEFAULT 0,
+        lease_owner TEXT,
+        lease_expires INTEGER,
+        created_at TEXT,
+        finished_at TEXT
+    )
+    """)
+
+def migrate_users_version(db):
+    # every write to users bumps bot_state.users_version, so other processes know to drop their user_cache
+    db.execute("INSERT OR IGNORE INTO bot_state(key, value) VALUES('users_version', '0')")
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        db.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS users_version_{event.lower()} AFTER {event} ON users BEGIN
+            UPDATE bot_state SET value = CAST(value AS INTEGER) + 1 WHERE key = 'users_version';
+        END
+        """)
+
+def migrate_groups_fts_title_trigger(db):
+    # the old trigger fired on every groups UPDATE, so each health-sweeper write rewrote the FTS row
+    db.execute("DROP TRIGGER IF EXISTS groups_fts_au")
+    if db.execute("SELECT 1 FROM sqlite_master WHERE name='groups_fts'").fetchone():
+        init_groups_fts(db)
+
+# (version, description, function); append only, never renumber
+MIGRATIONS = [
+    (1, "covering indexes for materials, referrals and users.active", migrate_covering_indexes),
+    (2, "users.plan_expiry_ts epoch column and expiry index", migrate_plan_expiry_epoch),
+    (3, "scheduled_promotions table", migrate_scheduled_promotions),
+    (4, "groups.status / last_verified_at health columns", migrate_group_health),
+    (5, "content-addressed material_blobs", migrate_material_blobs),
+    (6, "conversation_steps table", migrate_conversation_steps),
+    (7, "promotion job leases", migrate_promotion_job_leases),
+    (8, "broadcasts table and users.blocked_at", migrate_broadcasts),
+    (9, "users_version counter for cross-process user cache invalidation", migrate_users_version),
+    (10, "groups_fts update trigger limited to title changes", migrate_groups_fts_title_trigger),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def run_migrations(db):
+    """
+    Apply every migration newer than PRAGMA user_version, in order, inside the caller's transaction.
+    """
+    current = db.execute("PRAGMA user_version").fetchone()[0]
+    if current == 0:
+        create_base_schema(db)
+    for version, description, fn in MIGRATIONS:
+        if version <= current:
+            continue
+        started = time.perf_counter()
+        fn(db)
+        db.execute(f"PRAGMA user_version={int(version)}")
+        logging.info("Applied schema migration %s (%s) in %.1f ms", version, description, (time.perf_counter() - started) * 1000)
+
+def init_db():
+    """
+    Bring the database up to SCHEMA_VERSION. An up-to-date database costs one PRAGMA read and no write lock,
+    so restarts and extra workers don't queue behind each other on BEGIN IMMEDIATE.
+    """
+    global GROUPS_FTS
+    started = time.perf_counter()
+    conn = get_conn()
+    current = conn.execute("PRAGMA user_version").fetchone()[0]
+    if current < SCHEMA_VERSION:
+        with transaction() as db:
+            run_migrations(db)  # re-reads user_version under the write lock
+    GROUPS_FTS = bool(conn.execute("SELECT 1 FROM sqlite_master WHERE name='groups_fts'").fetchone())
+    logging.info("Schema at version %s (was %s), checked in %.1f ms", SCHEMA_VERSION, current,
+                 (time.perf_counter() - started) * 1000)
+
+init_db()
+
+
+# ---------------- CACHES ----------------
+class TTLCache:
+    """
+    Small thread-safe LRU cache whose entries expire `ttl` seconds after being set.
+    """
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.version = 0  # bumped by every update/invalidate, see set(if_version=...)
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            value, expires = item
+            if expires < time.monotonic():
+                del self.data[key]
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, if_version=None):
+        """
+        Store a value. With `if_version`, skip the store if any write happened since that
+        version was read, so a slow reader can't put back a value that was just replaced.
+        """
+        with self.lock:
+            if if_version is not None and if_version != self.version:
+                return
+            self.data[key] = (value, time.monotonic() + self.ttl)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def update(self, key, fn):
+        """
+        Replace a cached value with fn(value); no-op if the key is not cached.
+        """
+        with self.lock:
+            self.version += 1
+            item = self.data.get(key)
+            if item is not None:
+                self.data[key] = (fn(item[0]), item[1])
+
+    def invalidate(self, key):
+        with self.lock:
+            self.version += 1
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.version += 1
+            self.data.clear()
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {'size': len(self.data), 'max_size': self.maxsize, 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': round(self.hits / total, 3) if total else None}
+
+
+admin_status_cache = TTLCache(ADMIN_CACHE_TTL, ADMIN_CACHE_SIZE)
+# keyed by content hash, so an entry can never go stale
+material_text_cache = TTLCache(float("inf"), MATERIAL_BODY_CACHE_SIZE)
+user_cache = TTLCache(USER_CACHE_TTL, USER_CACHE_SIZE)
+_bot_user = None
+_bot_user_lock = threading.Lock()
+
+def get_bot_user():
+    """
+    The bot's own User object; fetched from Telegram once per process.
+    """
+    global _bot_user
+    if _bot_user is None:
+        with _bot_user_lock:
+            if _bot_user is None:
+                _bot_user = bot.get_me()
+    return _bot_user
 
 # ---------------- HELPERS ----------------
 def save_user(user, ref_code=None):
     """
     Save new user. If ref_code is provided (format REF{user_id}) then set referred_by.
     """
-    cur.execute("SELECT 1 FROM users WHERE user_id=?", (user.id,))
-    if cur.fetchone():
+    if db_fetchone("SELECT 1 FROM users WHERE user_id=?", (user.id,)):
         return
 
     ref = f"REF{user.id}"
@@ -111,99 +935,331 @@ def save_user(user, ref_code=None):
         if m:
             referred_by = int(m.group(1))
 
-    cur.execute(
-        "INSERT INTO users(user_id, username, first_name, joined, referral, referred_by) VALUES(?,?,?,?,?,?)",
-        (user.id, user.username or "", user.first_name or "", datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"), ref, referred_by)
-    )
-    conn.commit()
+    now = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    with transaction() as db:
+        inserted = db.execute(
+            "INSERT OR IGNORE INTO users(user_id, username, first_name, joined, referral, referred_by) VALUES(?,?,?,?,?,?)",
+            (user.id, user.username or "", user.first_name or "", now, ref, referred_by)
+        ).rowcount
+        # If referred_by is present, create a referral record (credited later immediately if possible)
+        if inserted and referred_by:
+            db.execute("INSERT OR IGNORE INTO referrals(new_user_id, referrer_user_id, credited, created_at) VALUES(?,?,?,?)",
+                       (user.id, referred_by, 0, now))
 
-    # If referred_by is present, create a referral record (credited later immediately if possible)
-    if referred_by:
-        try:
-            cur.execute("INSERT OR IGNORE INTO referrals(new_user_id, referrer_user_id, credited, created_at) VALUES(?,?,?,?)",
-                        (user.id, referred_by, 0, datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")))
-            conn.commit()
-        except Exception as e:
-            logging.exception("referral create failed: %s", e)
 
+USER_COLUMNS = ["user_id","username","first_name","joined","active","plan","plan_expiry","referral","wallet","referred_by",
+                "plan_expiry_ts","expiry_reminded"]
+
+_users_version = None
+_users_version_checked = 0.0
+
+def sync_user_cache():
+    """
+    Drop user_cache if the users table changed since the last check, in this or another process
+    (a trigger bumps users_version). Checked at most every USER_CACHE_SYNC seconds.
+    """
+    global _users_version, _users_version_checked
+    now = time.monotonic()
+    if now - _users_version_checked < USER_CACHE_SYNC:
+        return
+    _users_version_checked = now
+    version = get_state("users_version")
+    if version != _users_version:
+        if _users_version is not None:
+            user_cache.clear()
+        _users_version = version
 
 def get_user(uid):
-    cur.execute("SELECT user_id,username,first_name,joined,active,plan,plan_expiry,referral,wallet,referred_by FROM users WHERE user_id=?", (uid,))
-    row = cur.fetchone()
+    """
+    User row as a dict, served from user_cache when possible.
+    Inside a transaction the database is always read, so read-modify-write sees committed data.
+    """
+    if not in_transaction():
+        sync_user_cache()
+        cached = user_cache.get(uid)
+        if cached is not None:
+            return dict(cached)
+    version = user_cache.version
+    row = db_fetchone(f"SELECT {','.join(USER_COLUMNS)} FROM users WHERE user_id=?", (uid,))
     if not row:
         return None
-    keys = ["user_id","username","first_name","joined","active","plan","plan_expiry","referral","wallet","referred_by"]
-    return dict(zip(keys, row))
+    u = dict(zip(USER_COLUMNS, row))
+    if not in_transaction():
+        user_cache.set(uid, u, if_version=version)
+    return dict(u)
 
-def update_user(uid, field, value):
-    cur.execute(f"UPDATE users SET {field}=? WHERE user_id=?", (value, uid))
-    conn.commit()
+def update_user(uid, **fields):
+    """
+    Update several columns of one user in a single statement, e.g. update_user(uid, active=1, plan="1M").
+    The cached copy is updated too, or dropped once the surrounding transaction commits: dropping it
+    earlier would let a concurrent reader cache the pre-commit row again.
+    """
+    bad = set(fields) - set(USER_COLUMNS[1:])
+    if bad or not fields:
+        raise ValueError(f"invalid user fields: {sorted(bad) or 'none given'}")
+    cols = ", ".join(f"{k}=?" for k in fields)
+    db_execute(f"UPDATE users SET {cols} WHERE user_id=?", (*fields.values(), uid))
+    if in_transaction():
+        invalidate_user(uid)
+    else:
+        user_cache.update(uid, lambda u: {**u, **fields})
 
-def add_wallet(uid, amount):
-    u = get_user(uid)
-    if not u:
-        return False
-    new = (u['wallet'] or 0) + int(amount)
-    update_user(uid, "wallet", new)
+def invalidate_user(uid):
+    on_commit(lambda: user_cache.invalidate(uid))
+
+def has_active_plan(u):
+    """
+    Active flag set and not past expiry (the sweeper may not have run yet).
+    """
+    return bool(u and u['active'] and (not u['plan_expiry_ts'] or u['plan_expiry_ts'] > time.time()))
+
+def add_wallet(uid, amount, reason="manual", key=None):
+    """
+    Credit (or debit, with a negative amount) a wallet and record it in wallet_transactions.
+    `key` makes the credit idempotent: a second call with the same key changes nothing.
+    Returns True if the balance changed.
+    """
+    now = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    with transaction() as db:
+        if not db.execute("SELECT 1 FROM users WHERE user_id=?", (uid,)).fetchone():
+            return False
+        if not db.execute("INSERT OR IGNORE INTO wallet_transactions(user_id, amount, reason, idempotency_key, created_at) VALUES(?,?,?,?,?)",
+                          (uid, int(amount), reason, key, now)).rowcount:
+            return False
+        # relative update: concurrent credits can't overwrite each other
+        db.execute("UPDATE users SET wallet = COALESCE(wallet, 0) + ? WHERE user_id=?", (int(amount), uid))
+    invalidate_user(uid)
     return True
 
 def save_material(uid, text):
-    cur.execute("INSERT INTO materials(user_id, text_data, created_at) VALUES(?,?,?)", (uid, text, datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")))
-    conn.commit()
+    """
+    Store the text once per distinct content and give the user a reference to it.
+    Saving a text the user already has returns the existing material id.
+    """
+    blob = material_blob(text)
+    with transaction() as db:
+        row = db.execute("SELECT id FROM materials WHERE user_id=? AND blob_hash=?", (uid, blob[0])).fetchone()
+        if row:
+            return row[0]
+        db.execute("INSERT OR IGNORE INTO material_blobs(hash, body, size) VALUES(?,?,?)", blob)
+        mid = db.execute("INSERT INTO materials(user_id, blob_hash, created_at) VALUES(?,?,?)",
+                         (uid, blob[0], datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"))).lastrowid
+    material_text_cache.set(blob[0], text)
+    return mid
+
+def material_texts(hashes):
+    """
+    {hash: text} for blob hashes: cached texts first, the rest decompressed from one query.
+    """
+    texts = {}
+    missing = []
+    for h in hashes:
+        text = material_text_cache.get(h)
+        if text is None:
+            missing.append(h)
+        else:
+            texts[h] = text
+    if missing:
+        rows = db_fetchall(f"SELECT hash, body FROM material_blobs WHERE hash IN ({','.join('?' * len(missing))})", missing)
+        for h, body in rows:
+            texts[h] = zlib.decompress(body).decode("utf-8")
+            material_text_cache.set(h, texts[h])
+    return texts
+
+def with_material_texts(rows):
+    """
+    (id, blob_hash, created_at) rows -> (id, text, created_at).
+    """
+    texts = material_texts({r[1] for r in rows})
+    return [(mid, texts.get(h, ""), created_at) for mid, h, created_at in rows]
 
 def get_materials(uid):
-    cur.execute("SELECT id, text_data, created_at FROM materials WHERE user_id=? ORDER BY id DESC", (uid,))
-    return cur.fetchall()
+    return with_material_texts(db_fetchall("SELECT id, blob_hash, created_at FROM materials WHERE user_id=? ORDER BY id DESC", (uid,)))
 
-def delete_material(uid, mid=None):
-    if mid:
-        cur.execute("DELETE FROM materials WHERE user_id=? AND id=?", (uid, mid))
+def get_materials_page(uid, before_id=None, after_id=None, limit=MATERIALS_PAGE_SIZE):
+    """
+    One page of a user's materials, newest first, using keyset pagination on (user_id, id).
+    `before_id` pages towards older rows, `after_id` towards newer ones.
+    Returns (rows, has_older, has_newer).
+    """
+    if after_id is not None:
+        rows = db_fetchall("SELECT id, blob_hash, created_at FROM materials WHERE user_id=? AND id>? ORDER BY id ASC LIMIT ?",
+                           (uid, after_id, limit + 1))
+        has_newer = len(rows) > limit
+        rows = rows[:limit][::-1]
+        has_older = bool(rows) and db_fetchone("SELECT 1 FROM materials WHERE user_id=? AND id<? LIMIT 1", (uid, rows[-1][0])) is not None
     else:
-        cur.execute("DELETE FROM materials WHERE user_id=?", (uid,))
-    conn.commit()
+        if before_id is not None:
+            rows = db_fetchall("SELECT id, blob_hash, created_at FROM materials WHERE user_id=? AND id<? ORDER BY id DESC LIMIT ?",
+                               (uid, before_id, limit + 1))
+        else:
+            rows = db_fetchall("SELECT id, blob_hash, created_at FROM materials WHERE user_id=? ORDER BY id DESC LIMIT ?",
+                               (uid, limit + 1))
+        has_older = len(rows) > limit
+        rows = rows[:limit]
+        has_newer = before_id is not None and bool(rows) and \
+            db_fetchone("SELECT 1 FROM materials WHERE user_id=? AND id>? LIMIT 1", (uid, rows[0][0])) is not None
+    return with_material_texts(rows), has_older, has_newer
+
+def get_state(key, default=None):
+    row = db_fetchone("SELECT value FROM bot_state WHERE key=?", (key,))
+    return row[0] if row else default
+
+def count_materials(uid):
+    return db_fetchone("SELECT COUNT(*) FROM materials WHERE user_id=?", (uid,))[0]
+
+def get_referral_stats(uid):
+    """
+    (total referred, credited) for a referrer in one pass over idx_referrals_referrer.
+    """
+    row = db_fetchone("SELECT COUNT(*), COALESCE(SUM(credited=1), 0) FROM referrals WHERE referrer_user_id=?", (uid,))
+    return row[0], row[1]
 
-def register_group_record(chat_id, title, registered_by):
-    cur.execute("INSERT OR REPLACE INTO groups(chat_id,title,registered_by,registered_at) VALUES(?,?,?,?)",
-                (chat_id, title or "", registered_by, datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")))
-    conn.commit()
+def get_material_text(uid, mid):
+    row = db_fetchone("SELECT blob_hash FROM materials WHERE id=? AND user_id=?", (mid, uid))
+    return material_texts([row[0]]).get(row[0]) if row else None
+
+def delete_material(uid, mid=None):
+    """
+    Drop one (or all) of a user's materials, and the blobs no other material points to any more.
+    """
+    with transaction() as db:
+        if mid:
+            hashes = db.execute("DELETE FROM materials WHERE user_id=? AND id=? RETURNING blob_hash", (uid, mid)).fetchall()
+        else:
+            hashes = db.execute("DELETE FROM materials WHERE user_id=? RETURNING blob_hash", (uid,)).fetchall()
+        db.executemany("DELETE FROM material_blobs WHERE hash=? AND NOT EXISTS (SELECT 1 FROM materials WHERE blob_hash=?)",
+                       [(h, h) for (h,) in set(hashes)])
 
-def get_registered_groups():
-    cur.execute("SELECT chat_id, title FROM groups ORDER BY title")
-    return cur.fetchall()
+def register_group_record(chat_id, title, registered_by):
+    # upsert instead of INSERT OR REPLACE: a replace deletes the row and would cascade to user selections
+    now = int(time.time())
+    db_execute("INSERT INTO groups(chat_id,title,registered_by,registered_at,status,status_since,last_verified_at) VALUES(?,?,?,?,'ok',?,?) "
+               "ON CONFLICT(chat_id) DO UPDATE SET title=excluded.title, registered_by=excluded.registered_by, registered_at=excluded.registered_at, "
+               "status='ok', status_since=excluded.status_since, last_verified_at=excluded.last_verified_at",
+               (chat_id, title or "", registered_by, datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"), now, now))
 
 def remove_group(chat_id):
-    cur.execute("DELETE FROM groups WHERE chat_id=?", (chat_id,))
-    conn.commit()
+    db_execute("DELETE FROM groups WHERE chat_id=?", (chat_id,))
 
 def save_selection(user_id, group_ids):
-    gid_str = ",".join([str(int(x)) for x in group_ids]) if group_ids else ""
-    cur.execute("INSERT OR REPLACE INTO selections(user_id, group_ids) VALUES(?,?)", (user_id, gid_str))
-    conn.commit()
+    with transaction() as db:
+        db.execute("DELETE FROM user_group_selection WHERE user_id=?", (user_id,))
+        db.executemany("INSERT OR IGNORE INTO user_group_selection(user_id, chat_id) SELECT ?, chat_id FROM groups WHERE chat_id=?",
+                       [(user_id, int(x)) for x in group_ids])
 
-def get_selection(user_id):
-    cur.execute("SELECT group_ids FROM selections WHERE user_id=?", (user_id,))
-    row = cur.fetchone()
-    if not row:
-        return []
-    if not row[0]:
-        return []
-    return [int(x) for x in row[0].split(",") if x.strip()]
+def toggle_selection(user_id, chat_id):
+    """
+    Select the group if it is not selected, otherwise deselect it.
+    Returns True if now selected, False if deselected, None if the group is not registered or flagged unusable.
+    """
+    with transaction() as db:
+        if db.execute("DELETE FROM user_group_selection WHERE user_id=? AND chat_id=?", (user_id, chat_id)).rowcount:
+            return False
+        if not db.execute("INSERT INTO user_group_selection(user_id, chat_id) SELECT ?, chat_id FROM groups WHERE chat_id=? AND status='ok'",
+                          (user_id, chat_id)).rowcount:
+            return None
+    return True
+
+def get_promotable_selection(user_id):
+    """
+    The user's selected groups that passed their last health check; flagged groups are left out of promotions.
+    """
+    return [r[0] for r in db_fetchall("SELECT s.chat_id FROM user_group_selection s JOIN groups g ON g.chat_id = s.chat_id "
+                                      "WHERE s.user_id=? AND g.status='ok'", (user_id,))]
+
+def count_selection(user_id):
+    return db_fetchone("SELECT COUNT(*) FROM user_group_selection WHERE user_id=?", (user_id,))[0]
+
+def select_groups(user_id, chat_ids):
+    with transaction() as db:
+        db.executemany("INSERT OR IGNORE INTO user_group_selection(user_id, chat_id) SELECT ?, chat_id FROM groups WHERE chat_id=? AND status='ok'",
+                       [(user_id, gid) for gid in chat_ids])
+
+def select_matching_groups(user_id, query):
+    where, params = group_filter(query)
+    with transaction() as db:
+        return db.execute(f"INSERT OR IGNORE INTO user_group_selection(user_id, chat_id) SELECT ?, chat_id FROM groups WHERE {where}",
+                          (user_id, *params)).rowcount
+
+def selected_among(user_id, chat_ids):
+    if not chat_ids:
+        return set()
+    marks = ",".join("?" * len(chat_ids))
+    return {r[0] for r in db_fetchall(f"SELECT chat_id FROM user_group_selection WHERE user_id=? AND chat_id IN ({marks})",
+                                      (user_id, *chat_ids))}
+
+def get_group_search(user_id):
+    row = db_fetchone("SELECT query FROM group_search WHERE user_id=?", (user_id,))
+    return row[0] if row else None
+
+def set_group_search(user_id, query):
+    if query:
+        db_execute("INSERT OR REPLACE INTO group_search(user_id, query) VALUES(?,?)", (user_id, query))
+    else:
+        db_execute("DELETE FROM group_search WHERE user_id=?", (user_id,))
+
+def group_filter(query):
+    """
+    SQL condition (and params) restricting `groups` to usable groups whose titles match a search query.
+    Groups the health sweeper flagged ('dead', 'not_admin') are never offered.
+    """
+    if not query:
+        return "status='ok'", ()
+    if GROUPS_FTS:
+        tokens = re.findall(r"\w+", query)
+        if tokens:
+            # prefix match on every word: "crypto sig" finds "Crypto Signals"
+            return "status='ok' AND chat_id IN (SELECT rowid FROM groups_fts WHERE groups_fts MATCH ?)", (" ".join(f'"{t}"*' for t in tokens),)
+    return "status='ok' AND title LIKE ? ESCAPE '\\'", ("%" + re.sub(r"([%_\\])", r"\\\1", query) + "%",)
+
+def get_groups_page(query=None, cursor=None, limit=GROUPS_PAGE_SIZE):
+    """
+    One page of registered groups ordered by (title, chat_id), optionally filtered by a search query.
+    cursor is None (first page), ('n', chat_id) rows after it, ('p', chat_id) rows before it,
+    or ('s', chat_id) rows starting at it. Returns (rows, has_prev, has_next).
+    """
+    where, params = group_filter(query)
+    anchor = "(SELECT title, chat_id FROM groups WHERE chat_id=?)"
+    mode, gid = cursor or (None, None)
+    if mode == "p":
+        rows = db_fetchall(f"SELECT chat_id, title FROM groups WHERE {where} AND (title, chat_id) < {anchor} "
+                           f"ORDER BY title DESC, chat_id DESC LIMIT ?", (*params, gid, limit + 1))
+        has_prev = len(rows) > limit
+        rows = rows[:limit][::-1]
+        has_next = bool(rows) and db_fetchone(f"SELECT 1 FROM groups WHERE {where} AND (title, chat_id) > (?, ?) LIMIT 1",
+                                              (*params, rows[-1][1], rows[-1][0])) is not None
+    else:
+        cond, extra = "", ()
+        if mode:
+            cond, extra = f"AND (title, chat_id) {'>' if mode == 'n' else '>='} {anchor}", (gid,)
+        rows = db_fetchall(f"SELECT chat_id, title FROM groups WHERE {where} {cond} ORDER BY title, chat_id LIMIT ?",
+                           (*params, *extra, limit + 1))
+        has_next = len(rows) > limit
+        rows = rows[:limit]
+        has_prev = mode is not None and bool(rows) and db_fetchone(
+            f"SELECT 1 FROM groups WHERE {where} AND (title, chat_id) < (?, ?) LIMIT 1",
+            (*params, rows[0][1], rows[0][0])) is not None
+    if not rows and cursor:
+        # the anchor group was removed meanwhile: start over
+        return get_groups_page(query, None, limit)
+    return rows, has_prev, has_next
 
 def process_pending_referral(new_user_id):
     """
     If a referral record exists for this new user and not credited, credit referrer 10 points once.
     """
-    cur.execute("SELECT referrer_user_id, credited FROM referrals WHERE new_user_id=?", (new_user_id,))
-    row = cur.fetchone()
-    if not row:
+    # cheap read first: most /start calls have nothing to credit and shouldn't take the write lock
+    if not db_fetchone("SELECT 1 FROM referrals WHERE new_user_id=? AND credited=0", (new_user_id,)):
         return False
-    referrer_id, credited = row
-    if credited:
-        return False
-    # Add 10 points to referrer wallet
-    add_wallet(referrer_id, 10)
-    cur.execute("UPDATE referrals SET credited=1 WHERE new_user_id=?", (new_user_id,))
-    conn.commit()
+    with transaction() as db:
+        # flipping the flag is the claim: only one concurrent caller sees rowcount 1
+        if not db.execute("UPDATE referrals SET credited=1 WHERE new_user_id=? AND credited=0", (new_user_id,)).rowcount:
+            return False
+        referrer_id = db.execute("SELECT referrer_user_id FROM referrals WHERE new_user_id=?", (new_user_id,)).fetchone()[0]
+        # Add 10 points to referrer wallet, in the same commit as the flag
+        if not add_wallet(referrer_id, 10, reason="referral", key=f"referral:{new_user_id}"):
+            return False
     try:
         bot.send_message(referrer_id, f"🎉 You earned <b>10 points</b> because a new user joined using your referral! Your wallet updated.", parse_mode="HTML")
     except Exception:
@@ -212,15 +1268,116 @@ def process_pending_referral(new_user_id):
 
 def bot_is_admin_in(chat_id):
     """
-    Check whether the bot is admin in a chat (returns True/False)
+    Check whether the bot is admin in a chat (returns True/False).
+    Answers are cached for ADMIN_CACHE_TTL seconds; my_chat_member updates refresh them.
+    Transient Telegram errors (429, 5xx) are raised, so callers can retry instead of skipping the chat.
     """
+    cached = admin_status_cache.get(chat_id)
+    if cached is not None:
+        return cached
     try:
-        member = bot.get_chat_member(chat_id, bot.get_me().id)
+        member = bot.get_chat_member(chat_id, get_bot_user().id)
         # statuses: 'administrator', 'creator', 'member', 'left', 'kicked'
-        return member.status in ("administrator", "creator")
+        is_admin = member.status in ("administrator", "creator")
+    except ChatUnavailable:
+        # circuit open after a recent 403: "no" for now, the breaker decides when to ask again
+        return False
+    except telebot.apihelper.ApiTelegramException as e:
+        if e.error_code not in (400, 403):
+            raise
+        # Telegram answered (chat not found, bot kicked, ...): that is a real "no"
+        logging.debug("get_chat_member failed for %s: %s", chat_id, e)
+        is_admin = False
     except Exception as e:
+        # network trouble: don't cache, let the next call retry
         logging.debug("get_chat_member failed for %s: %s", chat_id, e)
         return False
+    admin_status_cache.set(chat_id, is_admin)
+    return is_admin
+
+# ---------------- RATE LIMITING ----------------
+class TokenBucket:
+    """
+    Thread-safe token bucket: `rate` tokens per second, holding at most `capacity`.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self):
+        """
+        Take one token if available. Returns 0 on success, otherwise seconds until one is free.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """
+        Block until a token is taken.
+        """
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+class ChatRateLimiter:
+    """
+    One TokenBucket per chat, shared by every promotion running in this process.
+    With `maxsize`, only that many buckets are kept (least recently used dropped; a dropped key starts full again).
+    """
+    def __init__(self, rate, capacity, maxsize=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.maxsize = maxsize
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def bucket(self, chat_id):
+        with self.lock:
+            b = self.buckets.get(chat_id)
+            if b is None:
+                b = self.buckets[chat_id] = TokenBucket(self.rate, self.capacity)
+                if self.maxsize and len(self.buckets) > self.maxsize:
+                    self.buckets.popitem(last=False)
+            elif self.maxsize:
+                self.buckets.move_to_end(chat_id)
+            return b
+
+    def try_acquire(self, chat_id):
+        return self.bucket(chat_id).try_acquire()
+
+
+global_send_bucket = TokenBucket(GLOBAL_SEND_RATE, GLOBAL_SEND_BURST)
+# LRU-bounded: a bucket refills in PER_CHAT_SEND_BURST / PER_CHAT_SEND_RATE seconds (9 s by default), far less
+# than it takes the global send rate to touch CHAT_LIMITER_SIZE other chats, so an evicted bucket was full anyway
+chat_send_limiter = ChatRateLimiter(PER_CHAT_SEND_RATE, PER_CHAT_SEND_BURST, CHAT_LIMITER_SIZE)
+
+def send_rate_limited(chat_id, text, **kwargs):
+    """
+    bot.send_message within the per-chat and global budgets; blocks until both allow it.
+    For background senders (reminders, broadcasts) that share the budget with promotions.
+    """
+    while True:
+        wait = chat_send_limiter.try_acquire(chat_id)
+        if not wait:
+            break
+        time.sleep(wait)
+    global_send_bucket.acquire()
+    return bot.send_message(chat_id, text, **kwargs)
 
 # ---------------- KEYBOARDS ----------------
 def main_menu_kb():
@@ -261,6 +1418,201 @@ def support_kb():
     kb.add(types.InlineKeyboardButton("⬅️ Back", callback_data="back_main"))
     return kb
 
+def page_cursor(direction, mid):
+    """
+    Turn the 'n' (older than mid) / 'p' (newer than mid) of a page button into (before_id, after_id).
+    """
+    return (mid, None) if direction == "n" else (None, mid)
+
+def page_nav_row(prefix, rows, has_older, has_newer, labels=("◀️ Newer", "Older ▶️")):
+    nav = []
+    if has_newer:
+        nav.append(types.InlineKeyboardButton(labels[0], callback_data=f"{prefix}_p_{rows[0][0]}"))
+    if has_older:
+        nav.append(types.InlineKeyboardButton(labels[1], callback_data=f"{prefix}_n_{rows[-1][0]}"))
+    return nav
+
+def materials_page(uid, before_id=None, after_id=None):
+    """
+    Text and keyboard for one page of the material browser, or None if there is nothing to show.
+    """
+    rows, has_older, has_newer = get_materials_page(uid, before_id, after_id)
+    if not rows:
+        return None
+    kb = types.InlineKeyboardMarkup()
+    parts = ["📦 <b>Saved texts</b>"]
+    for mid, text, created_at in rows:
+        preview = (text[:300] + "...") if len(text) > 300 else text
+        # escaped after truncating: a cut tag or a stray "<" would make Telegram reject the whole page
+        parts.append(f"📝 <b>#{mid}</b> · {created_at}\n{html.escape(preview)}")
+        kb.row(types.InlineKeyboardButton(f"Send #{mid}", callback_data=f"sendmat_{mid}"),
+               types.InlineKeyboardButton(f"Delete #{mid}", callback_data=f"delmat_{mid}"))
+    nav = page_nav_row("matpg", rows, has_older, has_newer)
+    if nav:
+        kb.row(*nav)
+    kb.add(types.InlineKeyboardButton("⬅️ Back", callback_data="back_main"))
+    return "\n\n".join(parts), kb
+
+def promotion_materials_page(uid, before_id=None, after_id=None):
+    """
+    Text and keyboard for picking which material to promote, one page at a time.
+    """
+    rows, has_older, has_newer = get_materials_page(uid, before_id, after_id)
+    if not rows:
+        return None
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("📌 Send ALL saved texts", callback_data="prom_send_all"))
+    for mid, text, _ in rows:
+        preview = (text[:30] + "...") if len(text) > 30 else text
+        kb.add(types.InlineKeyboardButton(f"Send #{mid}: {preview}", callback_data=f"prom_send_{mid}"))
+    nav = page_nav_row("prompg", rows, has_older, has_newer)
+    if nav:
+        kb.row(*nav)
+    return "Choose which material to promote:", kb
+
+def groups_page(uid, cursor=None):
+    """
+    Text and keyboard for one page of the group picker with the user's selection checked.
+    Returns None if no groups are registered at all.
+    """
+    query = get_group_search(uid)
+    rows, has_prev, has_next = get_groups_page(query, cursor)
+    kb = types.InlineKeyboardMarkup()
+    if not rows:
+        if not query:
+            return None
+        kb.add(types.InlineKeyboardButton("✖️ Clear search", callback_data="grp_search_clear"))
+        kb.add(types.InlineKeyboardButton("⬅️ Back", callback_data="back_main"))
+        return f"No registered groups match <b>{html.escape(query)}</b>.", kb
+
+    first = rows[0][0]
+    selected = selected_among(uid, [r[0] for r in rows])
+    for gid, title in rows:
+        mark = "✅" if gid in selected else "▫️"
+        kb.add(types.InlineKeyboardButton(f"{mark} {title or str(gid)}", callback_data=f"selgroup_{gid}_{first}"))
+    kb.row(types.InlineKeyboardButton("☑️ Select page", callback_data=f"grpall_{first}"),
+           types.InlineKeyboardButton("☑️ Select all matching" if query else "☑️ Select all", callback_data=f"grpallq_{first}"))
+    nav = page_nav_row("grppg", rows, has_next, has_prev, labels=("◀️ Prev", "Next ▶️"))
+    if nav:
+        kb.row(*nav)
+    if query:
+        kb.add(types.InlineKeyboardButton("✖️ Clear search", callback_data="grp_search_clear"))
+    else:
+        kb.add(types.InlineKeyboardButton("🔍 Search", callback_data="grp_search"))
+    kb.add(types.InlineKeyboardButton("✅ Confirm selection", callback_data="sel_confirm"))
+    kb.add(types.InlineKeyboardButton("⬅️ Back", callback_data="back_main"))
+    text = f"Select groups to toggle selection (press again to deselect):\nSelected: {count_selection(uid)}"
+    if query:
+        text += f"\nSearch: <b>{html.escape(query)}</b>"
+    return text, kb
+
+def edit_page(c, page):
+    try:
+        bot.edit_message_text(page[0], c.message.chat.id, c.message.message_id, reply_markup=page[1])
+    except telebot.apihelper.ApiTelegramException as e:
+        # pressing the same button twice gives "message is not modified"
+        logging.debug("page edit failed: %s", e)
+
+# ---------------- CONVERSATION STATE ----------------
+class MemoryStepStore:
+    """
+    Pending "next message" steps keyed by (chat_id, user_id), in this process only.
+    Fine for a single worker; the next message must reach the process that asked for it.
+    """
+    def __init__(self):
+        self.steps = {}
+        self.lock = threading.Lock()
+
+    def set(self, chat_id, user_id, step, args=(), ttl=STEP_TTL):
+        with self.lock:
+            self.steps[(chat_id, user_id)] = (step, list(args), time.time() + ttl)
+
+    def peek(self, chat_id, user_id):
+        entry = self.steps.get((chat_id, user_id))
+        return entry is not None and entry[2] > time.time()
+
+    def pop(self, chat_id, user_id):
+        """
+        (step, args) and remove it, or None if nothing (unexpired) is pending.
+        """
+        with self.lock:
+            entry = self.steps.pop((chat_id, user_id), None)
+        if entry is None or entry[2] <= time.time():
+            return None
+        return entry[0], entry[1]
+
+    def clear(self, chat_id, user_id):
+        with self.lock:
+            self.steps.pop((chat_id, user_id), None)
+
+    def purge(self):
+        now = time.time()
+        with self.lock:
+            expired = [k for k, v in self.steps.items() if v[2] <= now]
+            for k in expired:
+                del self.steps[k]
+        return len(expired)
+
+
+class SQLiteStepStore(MemoryStepStore):
+    """
+    Same interface backed by the conversation_steps table, so any worker process can take the next message.
+    pop() is a single DELETE ... RETURNING: two workers can't both run a step.
+    """
+    def __init__(self):
+        pass
+
+    def set(self, chat_id, user_id, step, args=(), ttl=STEP_TTL):
+        db_execute("INSERT OR REPLACE INTO conversation_steps(chat_id, user_id, step, args, expires_at) VALUES(?,?,?,?,?)",
+                   (chat_id, user_id, step, json.dumps(list(args)), int(time.time() + ttl)))
+
+    def peek(self, chat_id, user_id):
+        return db_fetchone("SELECT 1 FROM conversation_steps WHERE chat_id=? AND user_id=? AND expires_at > ?",
+                           (chat_id, user_id, int(time.time()))) is not None
+
+    def pop(self, chat_id, user_id):
+        row = db_fetchone("DELETE FROM conversation_steps WHERE chat_id=? AND user_id=? RETURNING step, args, expires_at",
+                          (chat_id, user_id))
+        if row is None or row[2] <= time.time():
+            return None
+        return row[0], json.loads(row[1] or "[]")
+
+    def clear(self, chat_id, user_id):
+        db_execute("DELETE FROM conversation_steps WHERE chat_id=? AND user_id=?", (chat_id, user_id))
+
+    def purge(self):
+        return db_execute("DELETE FROM conversation_steps WHERE expires_at <= ?", (int(time.time()),)).rowcount
+
+
+step_store = SQLiteStepStore() if STEP_STORE == "sqlite" else MemoryStepStore()
+step_handlers = {}
+
+def step_handler(name):
+    """
+    Register a function that handles the message answering a prompt set up with expect_step(..., name).
+    """
+    def deco(func):
+        step_handlers[name] = func
+        return func
+    return deco
+
+def expect_step(chat_id, user_id, name, *args):
+    """
+    The user's next message in this chat goes to step handler `name` (called as handler(m, *args)).
+    Replaces bot.register_next_step_handler, which only worked inside one process.
+    """
+    step_store.set(chat_id, user_id, name, args)
+
+# registered before every other message handler: like next-step handlers, a pending step gets the message first
+@bot.message_handler(func=lambda m: m.from_user is not None and step_store.peek(m.chat.id, m.from_user.id),
+                     content_types=telebot.util.content_type_media)
+def run_pending_step(m):
+    pending = step_store.pop(m.chat.id, m.from_user.id)
+    if pending is None:
+        return  # expired, or another worker took it meanwhile
+    name, args = pending
+    step_handlers[name](m, *args)
+
 # ---------------- HANDLERS ----------------
 @bot.message_handler(commands=["start"])
 def start(m):
@@ -314,240 +1666,1275 @@ def materials(m):
 @bot.message_handler(func=lambda m: m.text == "🚀 Promotion Panel")
 def promotion(m):
     u = get_user(m.from_user.id)
-    if not u or not u['active']:
+    if not has_active_plan(u):
         bot.send_message(m.chat.id, f"❌ Subscription inactive.\nContact admin: {ADMIN_USERNAME}")
         return
     bot.send_message(m.chat.id, "Promotion Panel:", reply_markup=promotion_kb())
 
-@bot.message_handler(func=lambda m: m.text == "❓ Support")
-def support(m):
-    bot.send_message(m.chat.id, "Support:", reply_markup=support_kb())
+@bot.message_handler(func=lambda m: m.text == "❓ Support")
+def support(m):
+    bot.send_message(m.chat.id, "Support:", reply_markup=support_kb())
+
+# ---------------- CALLBACK ROUTER ----------------
+class CallbackRouter:
+    """
+    Dispatch callback_data with dict lookups instead of a comparison chain: exact payloads
+    first, then parameterized payloads by prefix ('sendmat_12' -> 'sendmat_' with int arg 12).
+    Per-route call count, total and max time are kept in `timings`.
+    """
+    def __init__(self):
+        self.exact = {}
+        self.prefixes = {}
+        self.timings = {}
+        self.lock = threading.Lock()
+
+    def route(self, data):
+        def deco(func):
+            self.exact[data] = func
+            return func
+        return deco
+
+    def prefix(self, prefix, *arg_types):
+        """
+        Register a handler for '<prefix><arg>_<arg>...'; args are converted with arg_types.
+        Trailing args may be missing (the handler should give them defaults).
+        """
+        # the first '<...>_' head that is registered wins, so no prefix may start with another one
+        assert not any(p.startswith(prefix) or prefix.startswith(p) for p in self.prefixes if p != prefix), prefix
+        def deco(func):
+            self.prefixes[prefix] = (func, arg_types)
+            return func
+        return deco
+
+    def resolve(self, data):
+        """
+        Returns (route, handler, args) or None if nothing matches or the arguments don't parse.
+        """
+        func = self.exact.get(data)
+        if func is not None:
+            return data, func, ()
+        # 'prom_send_5' -> try 'prom_', then 'prom_send_'
+        end = data.find("_")
+        while end > 0:
+            head = data[:end + 1]
+            entry = self.prefixes.get(head)
+            if entry is not None:
+                func, arg_types = entry
+                rest = data[end + 1:]
+                try:
+                    if len(arg_types) == 1:
+                        args = (arg_types[0](rest),)
+                    else:
+                        raw = rest.split("_", len(arg_types) - 1)
+                        args = tuple([t(v) for t, v in zip(arg_types, raw)])
+                except ValueError:
+                    return None
+                return head, func, args
+            end = data.find("_", end + 1)
+        return None
+
+    def dispatch(self, c):
+        found = self.resolve(c.data or "")
+        if found is None:
+            metrics.inc("bot_handler_errors_total", (("kind", "callback"), ("handler", "unknown")))
+            bot.answer_callback_query(c.id, text="Unknown callback.")
+            return
+        route, func, args = found
+        started = time.perf_counter()
+        try:
+            func(c, *args)
+        except Exception:
+            metrics.inc("bot_handler_errors_total", (("kind", "callback"), ("handler", route)))
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.observe("bot_handler_seconds", (("kind", "callback"), ("handler", route)), elapsed)
+            with self.lock:
+                t = self.timings.setdefault(route, [0, 0.0, 0.0])
+                t[0] += 1
+                t[1] += elapsed
+                t[2] = max(t[2], elapsed)
+
+    def stats(self):
+        with self.lock:
+            return {route: {'count': n, 'avg_ms': round(total * 1000 / n, 2), 'max_ms': round(worst * 1000, 2)}
+                    for route, (n, total, worst) in self.timings.items()}
+
+
+callbacks = CallbackRouter()
+
+# ---------------- INLINE CALLBACKS ----------------
+@bot.callback_query_handler(func=lambda c: True)
+def cb_handler(c):
+    callbacks.dispatch(c)
+
+# ----- materials -----
+@callbacks.route("mat_save")
+def cb_mat_save(c):
+    bot.send_message(c.message.chat.id, "Send me the text you want to save (I will store it):")
+    expect_step(c.message.chat.id, c.from_user.id, "save_text")
+    bot.answer_callback_query(c.id)
+
+@callbacks.route("mat_view")
+def cb_mat_view(c):
+    uid = c.from_user.id
+    page = materials_page(uid)
+    if not page:
+        bot.send_message(uid, "No saved texts.")
+        bot.answer_callback_query(c.id)
+        return
+    bot.send_message(uid, page[0], reply_markup=page[1])
+    bot.answer_callback_query(c.id)
+
+@callbacks.prefix("matpg_", str, int)
+def cb_mat_page(c, direction, mid):
+    page = materials_page(c.from_user.id, *page_cursor(direction, mid))
+    if not page:
+        bot.answer_callback_query(c.id, text="No more saved texts.")
+        return
+    edit_page(c, page)
+    bot.answer_callback_query(c.id)
+
+@callbacks.prefix("delmat_", int)
+def cb_delete_material(c, mid):
+    uid = c.from_user.id
+    delete_material(uid, mid)
+    bot.send_message(uid, f"Deleted material #{mid}.")
+    bot.answer_callback_query(c.id)
+
+@callbacks.prefix("sendmat_", int)
+def cb_send_material(c, mid):
+    uid = c.from_user.id
+    text = get_material_text(uid, mid)
+    if text is None:
+        bot.send_message(uid, "Material not found.")
+        bot.answer_callback_query(c.id)
+        return
+    bot.send_message(uid, text)
+    bot.answer_callback_query(c.id)
+
+@callbacks.route("mat_clear")
+def cb_mat_clear(c):
+    uid = c.from_user.id
+    delete_material(uid)
+    bot.send_message(uid, "All your saved materials have been cleared.")
+    bot.answer_callback_query(c.id)
+
+# ----- wallet/ref -----
+@callbacks.route("wallet_balance")
+def cb_wallet_balance(c):
+    uid = c.from_user.id
+    u = get_user(uid)
+    bot.send_message(uid, f"💰 Your wallet balance: <b>{u['wallet']} points</b>")
+    bot.answer_callback_query(c.id)
+
+@callbacks.route("ref_link")
+def cb_ref_link(c):
+    uid = c.from_user.id
+    u = get_user(uid)
+    link = f"https://t.me/{get_bot_user().username}?start={u['referral']}"
+    bot.send_message(uid, f"👥 Your Referral Link:\n{link}\n\nShare it — you'll get 10 points for each new user who joins with your link (credited once per user).")
+    bot.answer_callback_query(c.id)
+
+@callbacks.route("ref_stats")
+def cb_ref_stats(c):
+    uid = c.from_user.id
+    total, credited = get_referral_stats(uid)
+    bot.send_message(uid, f"Referral stats:\nTotal referred (joined): {total}\nCredited: {credited}")
+    bot.answer_callback_query(c.id)
+
+# ----- promotion -----
+@callbacks.route("prom_show_groups")
+def cb_show_groups(c):
+    uid = c.from_user.id
+    set_group_search(uid, None)
+    page = groups_page(uid)
+    if not page:
+        bot.send_message(uid, "No groups registered yet. Invite the bot to a group and run /register_group in that group or ask admin to add groups.")
+        bot.answer_callback_query(c.id)
+        return
+    bot.send_message(uid, page[0], reply_markup=page[1])
+    bot.answer_callback_query(c.id)
+
+@callbacks.prefix("grppg_", str, int)
+def cb_groups_page(c, mode, gid):
+    page = groups_page(c.from_user.id, (mode, gid))
+    if page:
+        edit_page(c, page)
+    bot.answer_callback_query(c.id)
+
+@callbacks.prefix("selgroup_", int, int)
+def cb_select_group(c, gid, first=None):
+    # selgroup_<chat_id>_<first chat_id on the page>
+    uid = c.from_user.id
+    selected = toggle_selection(uid, gid)
+    if selected is None:
+        bot.answer_callback_query(c.id, text="This group is no longer available (removed, or the bot lost admin rights).")
+        return
+    if first is not None:
+        page = groups_page(uid, ("s", first))
+        if page:
+            edit_page(c, page)
+    bot.answer_callback_query(c.id, text="Selected." if selected else "Deselected.")
+
+@callbacks.prefix("grpallq_", int)
+def cb_select_matching(c, first):
+    uid = c.from_user.id
+    added = select_matching_groups(uid, get_group_search(uid))
+    page = groups_page(uid, ("s", first))
+    if page:
+        edit_page(c, page)
+    bot.answer_callback_query(c.id, text=f"Selected {added} more groups.")
+
+@callbacks.prefix("grpall_", int)
+def cb_select_page(c, first):
+    uid = c.from_user.id
+    rows = get_groups_page(get_group_search(uid), ("s", first))[0]
+    select_groups(uid, [r[0] for r in rows])
+    page = groups_page(uid, ("s", rows[0][0])) if rows else None
+    if page:
+        edit_page(c, page)
+    bot.answer_callback_query(c.id, text="Selected all groups on this page.")
+
+@callbacks.route("grp_search")
+def cb_group_search(c):
+    bot.send_message(c.from_user.id, "Send part of the group name to search for:")
+    expect_step(c.from_user.id, c.from_user.id, "group_search")
+    bot.answer_callback_query(c.id)
+
+@callbacks.route("grp_search_clear")
+def cb_group_search_clear(c):
+    uid = c.from_user.id
+    set_group_search(uid, None)
+    page = groups_page(uid)
+    if page:
+        edit_page(c, page)
+    bot.answer_callback_query(c.id)
+
+@callbacks.route("sel_confirm")
+def cb_sel_confirm(c):
+    uid = c.from_user.id
+    count = count_selection(uid)
+    if not count:
+        bot.send_message(uid, "No groups selected. Use the group buttons to select groups first.")
+        bot.answer_callback_query(c.id)
+        return
+    bot.send_message(uid, f"Selected {count} groups for promotion. When you start promotion the bot will check admin permission on each group before sending.")
+    bot.answer_callback_query(c.id)
+
+@callbacks.route("prom_clear")
+def cb_prom_clear(c):
+    uid = c.from_user.id
+    save_selection(uid, [])
+    bot.send_message(uid, "Cleared selected groups.")
+    bot.answer_callback_query(c.id)
+
+def plan_gate(c):
+    """
+    Promotion buttons re-check the plan: an old inline keyboard stays clickable after the plan expires.
+    """
+    if has_active_plan(get_user(c.from_user.id)):
+        return True
+    bot.answer_callback_query(c.id, text=f"❌ Subscription inactive. Contact admin: {ADMIN_USERNAME}", show_alert=True)
+    return False
+
+@callbacks.route("prom_start")
+def cb_prom_start(c):
+    uid = c.from_user.id
+    if not plan_gate(c):
+        return
+    if not count_selection(uid):
+        bot.send_message(uid, "No groups selected. Select groups first.")
+        bot.answer_callback_query(c.id)
+        return
+    # Ask for which material to send or "all"
+    page = promotion_materials_page(uid)
+    if not page:
+        bot.send_message(uid, "You have no saved materials to promote. Save texts first.")
+        bot.answer_callback_query(c.id)
+        return
+    bot.send_message(uid, page[0], reply_markup=page[1])
+    bot.answer_callback_query(c.id)
+
+@callbacks.prefix("prompg_", str, int)
+def cb_prom_page(c, direction, mid):
+    page = promotion_materials_page(c.from_user.id, *page_cursor(direction, mid))
+    if not page:
+        bot.answer_callback_query(c.id, text="No more saved texts.")
+        return
+    edit_page(c, page)
+    bot.answer_callback_query(c.id)
+
+@callbacks.route("prom_send_all")
+@callbacks.prefix("prom_send_", int)
+def cb_prom_send(c, mid=None):
+    uid = c.from_user.id
+    if not plan_gate(c):
+        return
+    sel = get_promotable_selection(uid)
+    if not sel:
+        if count_selection(uid):
+            bot.send_message(uid, "None of your selected groups is currently usable (bot removed or not admin).")
+        else:
+            bot.send_message(uid, "No groups selected.")
+        bot.answer_callback_query(c.id)
+        return
+
+    # choose messages
+    if mid is None:
+        messages = [r[1] for r in get_materials(uid)]
+    else:
+        text = get_material_text(uid, mid)
+        if text is None:
+            bot.send_message(uid, "Material not found.")
+            bot.answer_callback_query(c.id)
+            return
+        messages = [text]
+
+    job_id = enqueue_promotion_job(uid, sel, messages)
+    bot.send_message(uid, f"Promotion job #{job_id} queued for {len(sel)} groups. The bot will verify admin permission before sending and will skip where not admin.")
+    bot.answer_callback_query(c.id)
+
+# ----- support -----
+@callbacks.route("contact_admin")
+def cb_contact_admin(c):
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("Contact Admin via Telegram", url=f"https://t.me/{ADMIN_USERNAME.lstrip('@')}"))
+    bot.send_message(c.from_user.id, "Contact admin:", reply_markup=kb)
+    bot.answer_callback_query(c.id)
+
+@callbacks.route("bot_status")
+def cb_bot_status(c):
+    bot.send_message(c.from_user.id, "Bot is running.")
+    bot.answer_callback_query(c.id)
+
+# ----- plans -----
+@callbacks.prefix("plan_", str)
+def cb_plan(c, code):
+    uid = c.from_user.id
+    plans = {"1W":7,"1M":30,"3M":90,"1Y":365}
+    names = {"1W":"1 Week ($2)", "1M":"1 Month ($6)", "3M":"3 Months ($15)", "1Y":"1 Year ($30)"}
+    if code not in plans:
+        bot.send_message(uid, "Invalid plan.")
+        bot.answer_callback_query(c.id)
+        return
+    bot.send_message(uid, f"You selected <b>{names[code]}</b>. Contact admin to purchase: {ADMIN_USERNAME}")
+    bot.answer_callback_query(c.id)
+
+@callbacks.route("back_main")
+def cb_back_main(c):
+    bot.send_message(c.from_user.id, "Back to main menu.", reply_markup=main_menu_kb())
+    bot.answer_callback_query(c.id)
+
+# ---------------- PROMOTION WORKER ----------------
+def format_eta(seconds):
+    return str(timedelta(seconds=int(seconds))) if seconds is not None else "-"
+
+class PromotionDispatcher:
+    """
+    Fan `messages` out to `group_ids` on a pool of worker threads.
+    Every send takes a token from the global bucket and from the target chat's bucket.
+    A group whose chat bucket is empty is parked in a heap until it refills, so the
+    workers keep sending to other groups instead of sleeping.
+    """
+    def __init__(self, user_id, group_ids, messages, workers=PROMOTION_WORKERS, delivered=None, checkpoint=None):
+        """
+        `delivered` maps (chat_id, msg_index) -> status for work finished by an earlier run;
+        those deliveries are not sent again. `checkpoint(chat_id, msg_index, status)` is called
+        with 'pending' right before a send and with the outcome afterwards.
+        """
+        self.user_id = user_id
+        self.group_ids = list(group_ids)
+        self.messages = list(messages)
+        self.workers = max(1, min(workers, len(self.group_ids)))
+        self.total = len(self.group_ids) * len(self.messages)
+        self.delivered = delivered or {}
+        self.checkpoint = checkpoint
+
+        self.cond = threading.Condition()
+        self.in_flight = 0
+        self.stopped = False
+
+        self.verified = set()
+        self.throttled = {}   # (chat_id, msg_index) -> times parked on a 429
+        self.ok_groups = set()
+        self.skipped = []
+        self.sent = 0
+        self.failed = 0
+        self.done = 0
+        for (gid, _), status in self.delivered.items():
+            # a 'pending' row means the process died mid-send: count it as sent rather than risk a duplicate
+            if status in ("sent", "pending"):
+                self._record(gid, sent=1)
+            else:
+                self._record(gid, failed=1)
+
+        # heap of (ready_at, seq, chat_id, next message index); one entry per group so
+        # messages inside a group keep their order
+        self.ready = []
+        for seq, gid in enumerate(self.group_ids):
+            idx = self._pending_from(gid, 0)
+            if idx is not None:
+                self.ready.append((0, seq, gid, idx))
+        heapq.heapify(self.ready)
+        self.started = None
+        self.resumed = 0
+        self.status_msg_id = None
+        self.last_report = 0
+        self.report_lock = threading.Lock()
+
+    # ----- scheduling -----
+    def stop(self):
+        """
+        Stop handing out work (the job's lease was lost); sends already in flight finish.
+        """
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+    def _next(self):
+        with self.cond:
+            while True:
+                if self.stopped:
+                    return None
+                if not self.ready:
+                    if not self.in_flight:
+                        return None
+                    self.cond.wait()
+                    continue
+                wait = self.ready[0][0] - time.monotonic()
+                if wait > 0:
+                    self.cond.wait(wait)
+                    continue
+                self.in_flight += 1
+                return heapq.heappop(self.ready)
+
+    def _release(self, item):
+        with self.cond:
+            self.in_flight -= 1
+            if item:
+                heapq.heappush(self.ready, item)
+            self.cond.notify_all()
+
+    def _pending_from(self, gid, idx):
+        """
+        First message index >= idx not yet delivered to gid, or None.
+        """
+        while idx < len(self.messages):
+            if (gid, idx) not in self.delivered:
+                return idx
+            idx += 1
+        return None
+
+    def _mark(self, gid, idx, status):
+        if self.checkpoint:
+            try:
+                self.checkpoint(gid, idx, status)
+            except Exception as e:
+                logging.exception("checkpoint failed for %s #%s: %s", gid, idx, e)
+
+    def _record(self, gid, sent=0, failed=0):
+        with self.cond:
+            self.sent += sent
+            self.failed += failed
+            self.done += sent + failed
+            if sent:
+                self.ok_groups.add(gid)
+
+    def _step(self, seq, gid, idx):
+        """
+        Deliver the next message for one group. Returns the heap entry to requeue, if any.
+        """
+        if gid not in self.verified:
+            try:
+                is_admin = bot_is_admin_in(gid)
+            except apihelper.ApiTelegramException as e:
+                # 429 / 5xx while checking: park or fail this message like a failed send
+                return self._send_failed(seq, gid, idx, e)
+            if not is_admin:
+                with self.cond:
+                    self.skipped.append(gid)
+                self._fail_rest(gid, idx, "skipped")
+                return None
+            self.verified.add(gid)
+
+        wait = chat_send_limiter.try_acquire(gid)
+        if wait:
+            return (time.monotonic() + wait, seq, gid, idx)
+
+        global_send_bucket.acquire()
+        self._mark(gid, idx, "pending")
+        try:
+            bot.send_message(gid, self.messages[idx])
+        except Exception as e:
+            return self._send_failed(seq, gid, idx, e)
+        return self._send_ok(seq, gid, idx)
 
-# ---------------- INLINE CALLBACKS ----------------
-@bot.callback_query_handler(func=lambda c: True)
-def cb_handler(c):
-    data = c.data
-    uid = c.from_user.id
+    def _send_ok(self, seq, gid, idx):
+        self._mark(gid, idx, "sent")
+        self._record(gid, sent=1)
+        metrics.inc("promotion_messages_total", (("status", "sent"),))
+        return self._after(seq, gid, idx)
 
-    # ----- materials -----
-    if data == "mat_save":
-        msg = bot.send_message(c.message.chat.id, "Send me the text you want to save (I will store it):")
-        bot.register_next_step_handler(msg, handle_save_text)
-        bot.answer_callback_query(c.id)
+    def _send_failed(self, seq, gid, idx, e):
+        """
+        Outcome of a failed send; returns the heap entry to requeue, if any.
+        """
+        code = api_error_code(e)
+        if code == 429 and self.throttled.get((gid, idx), 0) < API_MAX_RETRIES:
+            # flood control longer than the API layer waits inline: park the group, keep the workers busy
+            self.throttled[(gid, idx)] = self.throttled.get((gid, idx), 0) + 1
+            self._mark(gid, idx, "retry")
+            return (time.monotonic() + retry_after(e), seq, gid, idx)
+        logging.warning("Failed to send to %s: %s", gid, e)
+        if code == 403:
+            # bot blocked or kicked: the remaining messages would fail the same way
+            self._fail_rest(gid, idx, "failed")
+            return None
+        # if a message fails in this group, continue with next message
+        self._mark(gid, idx, "failed")
+        self._record(gid, failed=1)
+        metrics.inc("promotion_messages_total", (("status", "failed"),))
+        metrics.inc("promotion_group_failures_total", (("chat_id", gid), ("status", "failed")))
+        return self._after(seq, gid, idx)
+
+    def _after(self, seq, gid, idx):
+        idx = self._pending_from(gid, idx + 1)
+        if idx is not None:
+            return (time.monotonic(), seq, gid, idx)
+        return None
 
-    elif data == "mat_view":
-        rows = get_materials(uid)
-        if not rows:
-            bot.send_message(uid, "No saved texts.")
-            bot.answer_callback_query(c.id)
+    def _fail_rest(self, gid, idx, status):
+        while idx is not None:
+            self._mark(gid, idx, status)
+            self._record(gid, failed=1)
+            metrics.inc("promotion_messages_total", (("status", status),))
+            metrics.inc("promotion_group_failures_total", (("chat_id", gid), ("status", status)))
+            idx = self._pending_from(gid, idx + 1)
+
+    def _work(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            _, seq, gid, idx = item
+            nxt = None
+            try:
+                nxt = self._step(seq, gid, idx)
+            except Exception as e:
+                logging.exception("Error during promotion to %s: %s", gid, e)
+                self._fail_rest(gid, idx, "failed")
+            finally:
+                self._release(nxt)
+            self._report()
+
+    # ----- progress -----
+    def _progress_text(self):
+        elapsed = time.monotonic() - self.started
+        rate = (self.done - self.resumed) / elapsed if elapsed > 0 else 0
+        eta = (self.total - self.done) / rate if rate else None
+        return (f"📤 Promotion in progress\n"
+                f"Sent: {self.sent}/{self.total}\n"
+                f"Failed/Skipped: {self.failed}\n"
+                f"Speed: {rate:.1f} msg/s\n"
+                f"ETA: {format_eta(eta)}")
+
+    def _report(self):
+        if self.status_msg_id is None or time.monotonic() - self.last_report < PROGRESS_INTERVAL:
             return
-        for r in rows:
-            text_preview = (r[1][:600] + "...") if len(r[1])>600 else r[1]
-            kb = types.InlineKeyboardMarkup()
-            kb.add(types.InlineKeyboardButton("Send Now", callback_data=f"sendmat_{r[0]}"))
-            kb.add(types.InlineKeyboardButton("Delete", callback_data=f"delmat_{r[0]}"))
-            bot.send_message(uid, f"📝 <b>Saved #{r[0]}</b>\n{r[2]}\n\n{text_preview}", reply_markup=kb)
-        bot.answer_callback_query(c.id)
-
-    elif data.startswith("delmat_"):
-        mid = int(data.split("_",1)[1])
-        delete_material(uid, mid)
-        bot.send_message(uid, f"Deleted material #{mid}.")
-        bot.answer_callback_query(c.id)
+        if not self.report_lock.acquire(blocking=False):
+            return
+        try:
+            self.last_report = time.monotonic()
+            bot.edit_message_text(self._progress_text(), self.user_id, self.status_msg_id)
+        except Exception as e:
+            logging.debug("progress update failed for %s: %s", self.user_id, e)
+        finally:
+            self.report_lock.release()
 
-    elif data.startswith("sendmat_"):
-        mid = int(data.split("_",1)[1])
-        cur.execute("SELECT text_data FROM materials WHERE id=? AND user_id=?", (mid, uid))
-        row = cur.fetchone()
-        if not row:
-            bot.send_message(uid, "Material not found.")
-            bot.answer_callback_query(c.id)
+    def run(self):
+        self.started = self.last_report = time.monotonic()
+        if not self.total:
             return
-        bot.send_message(uid, row[0])
-        bot.answer_callback_query(c.id)
+        self.resumed = self.done
+        try:
+            self.status_msg_id = bot.send_message(self.user_id, self._progress_text()).message_id
+        except Exception as e:
+            logging.info("Could not send progress message to %s: %s", self.user_id, e)
+
+        threads = [threading.Thread(target=self._work, daemon=True) for _ in range(self.workers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if not self.stopped:
+            bot.send_message(self.user_id, self._summary_text())
+
+    def _summary_text(self):
+        elapsed = time.monotonic() - self.started
+        total_groups = len(self.group_ids)
+        text = (f"Promotion finished.\nSuccessful groups: {len(self.ok_groups)}\n"
+                f"Failed/Skipped groups: {total_groups - len(self.ok_groups)}\nTotal attempted: {total_groups}\n"
+                f"Messages sent: {self.sent}/{self.total} in {format_eta(elapsed)}")
+        if self.skipped:
+            shown = ", ".join(str(g) for g in self.skipped[:20])
+            more = f" (+{len(self.skipped) - 20} more)" if len(self.skipped) > 20 else ""
+            text += f"\nSkipped (bot not admin or no access): {shown}{more}"
+        return text
+
+# ---------------- PROMOTION JOBS ----------------
+jobs_wakeup = threading.Event()
+
+def enqueue_promotion_job(user_id, group_ids, messages):
+    """
+    Persist a promotion job and wake a job worker. Returns the job id.
+    """
+    now = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    job_id = db_execute(
+        "INSERT INTO promotion_jobs(user_id, group_ids, messages, status, total, created_at) VALUES(?,?,?,?,?,?)",
+        (user_id, ",".join(str(int(g)) for g in group_ids), json.dumps(messages), "queued",
+         len(group_ids) * len(messages), now)).lastrowid
+    jobs_wakeup.set()
+    return job_id
 
-    elif data == "mat_clear":
-        delete_material(uid)
-        bot.send_message(uid, "All your saved materials have been cleared.")
-        bot.answer_callback_query(c.id)
+def worker_id():
+    # pid read on every call: gunicorn --preload imports the module before forking workers
+    return f"{socket.gethostname()}:{os.getpid()}"
 
-    # ----- wallet/ref -----
-    elif data == "wallet_balance":
-        u = get_user(uid)
-        bot.send_message(uid, f"💰 Your wallet balance: <b>{u['wallet']} points</b>")
-        bot.answer_callback_query(c.id)
 
-    elif data == "ref_link":
-        u = get_user(uid)
-        link = f"https://t.me/{bot.get_me().username}?start={u['referral']}"
-        bot.send_message(uid, f"👥 Your Referral Link:\n{link}\n\nShare it — you'll get 10 points for each new user who joins with your link (credited once per user).")
-        bot.answer_callback_query(c.id)
+class SenderLease:
+    """
+    Elects the one process that runs the background senders (promotion jobs, broadcasts, expiry
+    reminders, group sweeps), so several gunicorn workers still share one global send budget.
+    The holder renews a bot_state row every ttl/3 seconds; if it dies another process takes over after `ttl`.
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.until = 0.0  # monotonic; this process holds the lease until then
+
+    def held(self):
+        return time.monotonic() < self.until
+
+    def renew(self):
+        me = worker_id()
+        now = int(time.time())
+        with transaction() as db:
+            row = db.execute("SELECT value FROM bot_state WHERE key='sender_lease'").fetchone()
+            owner, _, expires = row[0].rpartition(" ") if row else ("", "", "0")
+            if owner != me and int(expires) > now:
+                self.until = 0.0
+                return False
+            db.execute("INSERT OR REPLACE INTO bot_state(key, value) VALUES('sender_lease', ?)", (f"{me} {now + self.ttl}",))
+        if not self.held():
+            logging.info("This process (%s) now runs the background senders", me)
+        # stop sending a third of the TTL before another process may take over
+        self.until = time.monotonic() + self.ttl * 2 / 3
+        return True
+
+    def run(self):
+        while True:
+            try:
+                self.renew()
+            except (sqlite3.Error, ValueError) as e:
+                logging.warning("sender lease renewal failed: %s", e)
+            time.sleep(self.ttl / 3)
+
+
+sender_lease = SenderLease(SENDER_LEASE_TTL)
+
+def claim_promotion_job():
+    """
+    Atomically take the oldest queued job, or a running one whose lease expired (its process died),
+    and lease it to this process for JOB_LEASE_TTL seconds. Returns (id, user_id, group_ids, messages) or None.
+    Jobs whose owner no longer has an active plan are cancelled instead of run.
+    """
+    now = int(time.time())
+    stamp = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    lapsed = []
+    with transaction() as db:
+        while True:
+            row = db.execute("SELECT id, user_id, group_ids, messages FROM promotion_jobs WHERE status='queued' "
+                             "OR (status='running' AND COALESCE(lease_expires, 0) < ?) ORDER BY id LIMIT 1", (now,)).fetchone()
+            if not row or has_active_plan(get_user(row[1])):
+                break
+            db.execute("UPDATE promotion_jobs SET status='cancelled', finished_at=?, lease_expires=NULL WHERE id=?", (stamp, row[0]))
+            lapsed.append(row[:2])
+        if row:
+            db.execute("UPDATE promotion_jobs SET status='running', started_at=COALESCE(started_at, ?), lease_owner=?, lease_expires=? WHERE id=?",
+                       (stamp, worker_id(), now + JOB_LEASE_TTL, row[0]))
+    for job_id, owner in lapsed:
+        metrics.inc("promotion_jobs_total", (("status", "cancelled"),))
+        logging.info("Cancelled promotion job #%s: subscription of %s inactive", job_id, owner)
+        try:
+            bot.send_message(owner, f"❌ Promotion job #{job_id} cancelled: your subscription is inactive.\nContact admin: {ADMIN_USERNAME}")
+        except Exception as e:
+            logging.info("Could not tell %s about cancelled job #%s: %s", owner, job_id, e)
+    if not row:
+        return None
+    job_id, user_id, gid_str, messages = row
+    group_ids = [int(x) for x in gid_str.split(",") if x.strip()]
+    return job_id, user_id, group_ids, json.loads(messages)
 
-    elif data == "ref_stats":
-        cur.execute("SELECT COUNT(*) FROM referrals WHERE referrer_user_id=?",(uid,))
-        total = cur.fetchone()[0] or 0
-        cur.execute("SELECT COUNT(*) FROM referrals WHERE referrer_user_id=? AND credited=1",(uid,))
-        credited = cur.fetchone()[0] or 0
-        bot.send_message(uid, f"Referral stats:\nTotal referred (joined): {total}\nCredited: {credited}")
-        bot.answer_callback_query(c.id)
+def get_job_deliveries(job_id):
+    # 'retry' rows were answered 429, i.e. not delivered: a resumed job sends them again
+    rows = db_fetchall("SELECT chat_id, msg_index, status FROM promotion_deliveries WHERE job_id=? AND status != 'retry'", (job_id,))
+    return {(gid, idx): status for gid, idx, status in rows}
 
-    # ----- promotion -----
-    elif data == "prom_show_groups":
-        groups = get_registered_groups()
-        if not groups:
-            bot.send_message(uid, "No groups registered yet. Invite the bot to a group and run /register_group in that group or ask admin to add groups.")
-            bot.answer_callback_query(c.id)
-            return
-        kb = types.InlineKeyboardMarkup()
-        for gid, title in groups:
-            label = f"{title or str(gid)}"
-            kb.add(types.InlineKeyboardButton(label, callback_data=f"selgroup_{gid}"))
-        kb.add(types.InlineKeyboardButton("✅ Confirm selection", callback_data="sel_confirm"))
-        kb.add(types.InlineKeyboardButton("⬅️ Back", callback_data="back_main"))
-        bot.send_message(uid, "Select groups to toggle selection (press again to deselect):", reply_markup=kb)
-        bot.answer_callback_query(c.id)
+def checkpoint_delivery(job_id, chat_id, msg_index, status):
+    """
+    Record the state of one (group, message) delivery; counters are bumped in the same commit.
+    """
+    now = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    with transaction() as db:
+        db.execute("INSERT OR REPLACE INTO promotion_deliveries(job_id, chat_id, msg_index, status, updated_at) VALUES(?,?,?,?,?)",
+                   (job_id, chat_id, msg_index, status, now))
+        if status == "sent":
+            db.execute("UPDATE promotion_jobs SET sent=sent+1 WHERE id=?", (job_id,))
+        elif status in ("failed", "skipped"):
+            db.execute("UPDATE promotion_jobs SET failed=failed+1 WHERE id=?", (job_id,))
+
+def finish_promotion_job(job_id, status):
+    metrics.inc("promotion_jobs_total", (("status", status),))
+    db_execute("UPDATE promotion_jobs SET status=?, finished_at=?, lease_expires=NULL WHERE id=? AND lease_owner=?",
+               (status, datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"), job_id, worker_id()))
+
+def renew_job_lease(job_id):
+    """
+    Extend this process's lease on a running job. False if the lease was lost to another process.
+    """
+    return db_execute("UPDATE promotion_jobs SET lease_expires=? WHERE id=? AND lease_owner=? AND status='running'",
+                      (int(time.time()) + JOB_LEASE_TTL, job_id, worker_id())).rowcount == 1
 
-    elif data.startswith("selgroup_"):
-        gid = int(data.split("_",1)[1])
-        sel = set(get_selection(uid))
-        if gid in sel:
-            sel.remove(gid)
-        else:
-            sel.add(gid)
-        save_selection(uid, list(sel))
-        bot.answer_callback_query(c.id, text="Updated selection.")
-
-    elif data == "sel_confirm":
-        sel = get_selection(uid)
-        if not sel:
-            bot.send_message(uid, "No groups selected. Use the group buttons to select groups first.")
-            bot.answer_callback_query(c.id)
-            return
-        bot.send_message(uid, f"Selected {len(sel)} groups for promotion. When you start promotion the bot will check admin permission on each group before sending.")
-        bot.answer_callback_query(c.id)
+def keep_job_lease(job_id, dispatcher, done):
+    """
+    Renew the lease every third of JOB_LEASE_TTL until `done` is set; stop the dispatcher if it is lost.
+    """
+    while not done.wait(JOB_LEASE_TTL / 3):
+        try:
+            if not renew_job_lease(job_id):
+                logging.warning("Lost the lease on promotion job #%s; another worker resumes it", job_id)
+                dispatcher.stop()
+                return
+        except sqlite3.Error as e:
+            logging.warning("lease renewal for job #%s failed: %s", job_id, e)
 
-    elif data == "prom_clear":
-        save_selection(uid, [])
-        bot.send_message(uid, "Cleared selected groups.")
-        bot.answer_callback_query(c.id)
+def recover_promotion_jobs():
+    """
+    Jobs left 'running' by a dead process are claimed again once their lease expires; their checkpoints make the resume duplicate-free.
+    """
+    n = db_fetchone("SELECT COUNT(*) FROM promotion_jobs WHERE status='running' AND COALESCE(lease_expires, 0) < ?",
+                    (int(time.time()),))[0]
+    if n:
+        logging.info("%s interrupted promotion job(s) will be resumed", n)
+
+def run_promotion_job(job_id, user_id, group_ids, messages):
+    delivered = get_job_deliveries(job_id)
+    if delivered:
+        logging.info("Resuming promotion job #%s (%s deliveries already done)", job_id, len(delivered))
+    dispatcher = PromotionDispatcher(user_id, group_ids, messages, delivered=delivered,
+                                     checkpoint=lambda gid, idx, status: checkpoint_delivery(job_id, gid, idx, status))
+    done = threading.Event()
+    threading.Thread(target=keep_job_lease, args=(job_id, dispatcher, done), daemon=True).start()
+    try:
+        dispatcher.run()
+        if not dispatcher.stopped:
+            finish_promotion_job(job_id, "done")
+    except Exception as e:
+        logging.exception("promotion job #%s failed: %s", job_id, e)
+        finish_promotion_job(job_id, "failed")
+    finally:
+        done.set()
+
+def promotion_job_worker():
+    while True:
+        job = claim_promotion_job() if sender_lease.held() else None
+        if job is None:
+            jobs_wakeup.wait(5)
+            jobs_wakeup.clear()
+            continue
+        run_promotion_job(*job)
+
+def start_promotion_job_workers():
+    recover_promotion_jobs()
+    for _ in range(PROMOTION_JOB_WORKERS):
+        threading.Thread(target=promotion_job_worker, daemon=True).start()
+
+def list_promotion_jobs(limit=20):
+    return db_fetchall("SELECT id, user_id, status, total, sent, failed, created_at FROM promotion_jobs ORDER BY id DESC LIMIT ?",
+                       (limit,))
+
+# ---------------- SCHEDULED PROMOTIONS ----------------
+class PromotionScheduler:
+    """
+    One thread with a min-heap of (next_run_ts, schedule id). Due schedules are turned into
+    promotion jobs. The database row is the source of truth: a heap entry whose time no longer
+    matches the row (edited, deleted, or fired by another process) is simply dropped.
+    """
+    def __init__(self):
+        self.heap = []
+        self.cond = threading.Condition()
 
-    elif data == "prom_start":
-        sel = get_selection(uid)
-        if not sel:
-            bot.send_message(uid, "No groups selected. Select groups first.")
-            bot.answer_callback_query(c.id)
+    def push(self, sched_id, next_run_ts):
+        with self.cond:
+            heapq.heappush(self.heap, (next_run_ts, sched_id))
+            self.cond.notify()
+
+    def load(self):
+        """
+        Fill the heap from the table. Schedules that came due while the bot was down fire once
+        (missed runs are coalesced), spread over SCHEDULE_SPREAD seconds instead of all at once.
+        """
+        now = int(time.time())
+        with transaction() as db:
+            rows = db.execute("SELECT id, next_run_ts FROM scheduled_promotions WHERE active=1").fetchall()
+            overdue = [(now + random.randint(0, SCHEDULE_SPREAD), sid) for sid, ts in rows if ts <= now]
+            db.executemany("UPDATE scheduled_promotions SET next_run_ts=? WHERE id=?", overdue)
+        overdue_ids = {sid for _, sid in overdue}
+        with self.cond:
+            self.heap = [(ts, sid) for sid, ts in rows if sid not in overdue_ids] + overdue
+            heapq.heapify(self.heap)
+            self.cond.notify()
+        if overdue:
+            logging.info("Loaded %s schedules, %s overdue after downtime", len(rows), len(overdue))
+
+    def run(self):
+        self.load()
+        while True:
+            with self.cond:
+                while not self.heap:
+                    self.cond.wait()
+                ts, sid = self.heap[0]
+                wait = ts - time.time()
+                if wait > 0:
+                    self.cond.wait(min(wait, 60))
+                    continue
+                heapq.heappop(self.heap)
+            try:
+                self.fire(sid, ts)
+            except Exception as e:
+                logging.exception("scheduled promotion %s failed: %s", sid, e)
+
+    def fire(self, sid, ts):
+        row = db_fetchone("SELECT user_id, material_id, interval_seconds FROM scheduled_promotions WHERE id=? AND active=1 AND next_run_ts=?",
+                          (sid, ts))
+        if not row:
             return
-        rows = get_materials(uid)
-        if not rows:
-            bot.send_message(uid, "You have no saved materials to promote. Save texts first.")
-            bot.answer_callback_query(c.id)
+        user_id, material_id, interval = row
+        now = int(time.time())
+        next_ts = ts + interval
+        if next_ts <= now:
+            next_ts = now + interval
+        # compare-and-set on next_run_ts: only one process fires a given run
+        if not db_execute("UPDATE scheduled_promotions SET next_run_ts=?, last_run_ts=? WHERE id=? AND next_run_ts=?",
+                          (next_ts, now, sid, ts)).rowcount:
             return
+        self.push(sid, next_ts)
 
-        # Ask for which material to send or "all"
-        kb = types.InlineKeyboardMarkup()
-        kb.add(types.InlineKeyboardButton("📌 Send ALL saved texts", callback_data="prom_send_all"))
-        for r in rows[:10]:
-            kb.add(types.InlineKeyboardButton(f"Send #{r[0]}", callback_data=f"prom_send_{r[0]}"))
-        bot.send_message(uid, "Choose which material to promote:", reply_markup=kb)
-        bot.answer_callback_query(c.id)
-
-    elif data == "prom_send_all" or data.startswith("prom_send_"):
-        uid = c.from_user.id
-        sel = get_selection(uid)
-        if not sel:
-            bot.send_message(uid, "No groups selected.")
-            bot.answer_callback_query(c.id)
+        if not has_active_plan(get_user(user_id)):
+            logging.info("Skipping scheduled promotion %s: subscription of %s inactive", sid, user_id)
             return
-
-        # choose messages
-        messages = []
-        if data == "prom_send_all":
-            mats = get_materials(uid)
-            messages = [r[1] for r in mats]
+        group_ids = get_promotable_selection(user_id)
+        if material_id is None:
+            messages = [r[1] for r in get_materials(user_id)]
         else:
-            mid = int(data.split("_",2)[2])
-            cur.execute("SELECT text_data FROM materials WHERE id=? AND user_id=?", (mid, uid))
-            row = cur.fetchone()
-            if not row:
-                bot.send_message(uid, "Material not found.")
-                bot.answer_callback_query(c.id)
+            text = get_material_text(user_id, material_id)
+            if text is None:
+                db_execute("UPDATE scheduled_promotions SET active=0 WHERE id=?", (sid,))
+                send_rate_limited(user_id, f"⏰ Schedule #{sid} stopped: material #{material_id} no longer exists.")
                 return
-            messages = [row[0]]
+            messages = [text]
+        if not group_ids or not messages:
+            logging.info("Skipping scheduled promotion %s: no groups or materials", sid)
+            return
+        job_id = enqueue_promotion_job(user_id, group_ids, messages)
+        logging.info("Scheduled promotion %s queued as job #%s", sid, job_id)
 
-        bot.send_message(uid, f"Starting promotion to {len(sel)} groups. The bot will verify admin permission before sending and will skip where not admin.")
-        bot.answer_callback_query(c.id)
-        # run promotion in a thread so not block the callback (still single process)
-        threading.Thread(target=perform_promotion, args=(uid, sel, messages)).start()
-
-    # ----- support -----
-    elif data == "contact_admin":
-        kb = types.InlineKeyboardMarkup()
-        kb.add(types.InlineKeyboardButton("Contact Admin via Telegram", url=f"https://t.me/{ADMIN_USERNAME.lstrip('@')}"))
-        bot.send_message(uid, "Contact admin:", reply_markup=kb)
-        bot.answer_callback_query(c.id)
 
-    elif data == "bot_status":
-        bot.send_message(uid, "Bot is running.")
-        bot.answer_callback_query(c.id)
+promotion_scheduler = PromotionScheduler()
 
-    # ----- plans -----
-    elif data.startswith("plan_"):
-        code = data.split("_",1)[1]
-        plans = {"1W":7,"1M":30,"3M":90,"1Y":365}
-        names = {"1W":"1 Week ($2)", "1M":"1 Month ($6)", "3M":"3 Months ($15)", "1Y":"1 Year ($30)"}
-        if code not in plans:
-            bot.send_message(uid, "Invalid plan.")
-            bot.answer_callback_query(c.id)
-            return
-        bot.send_message(uid, f"You selected <b>{names[code]}</b>. Contact admin to purchase: {ADMIN_USERNAME}")
-        bot.answer_callback_query(c.id)
+def create_schedule(user_id, material_id, interval_seconds):
+    """
+    First run after one interval plus a random offset, so schedules created together don't fire together.
+    """
+    now = int(time.time())
+    next_ts = now + interval_seconds + random.randint(0, min(SCHEDULE_SPREAD, interval_seconds))
+    sid = db_execute("INSERT INTO scheduled_promotions(user_id, material_id, interval_seconds, next_run_ts, active, created_at) VALUES(?,?,?,?,1,?)",
+                     (user_id, material_id, interval_seconds, next_ts, datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"))).lastrowid
+    promotion_scheduler.push(sid, next_ts)
+    return sid, next_ts
+
+def list_schedules(user_id):
+    return db_fetchall("SELECT id, material_id, interval_seconds, next_run_ts FROM scheduled_promotions WHERE user_id=? AND active=1 ORDER BY id",
+                       (user_id,))
+
+def cancel_schedule(user_id, sid):
+    return db_execute("DELETE FROM scheduled_promotions WHERE id=? AND user_id=?", (sid, user_id)).rowcount > 0
+
+@bot.message_handler(commands=["schedule"])
+def schedule_command(m):
+    """
+    /schedule <material_id|all> <hours>: promote to the selected groups every <hours> hours.
+    """
+    uid = m.from_user.id
+    if not has_active_plan(get_user(uid)):
+        bot.send_message(m.chat.id, f"❌ Subscription inactive.\nContact admin: {ADMIN_USERNAME}")
+        return
+    parts = m.text.split()
+    usage = f"Usage: /schedule <material_id|all> <hours>\nExample: /schedule 12 6 (post material #12 every 6 hours, minimum {SCHEDULE_MIN_HOURS:g}h)"
+    if len(parts) != 3:
+        bot.send_message(m.chat.id, usage)
+        return
+    try:
+        material_id = None if parts[1].lower() == "all" else int(parts[1].lstrip("#"))
+        hours = float(parts[2])
+    except ValueError:
+        bot.send_message(m.chat.id, usage)
+        return
+    if hours < SCHEDULE_MIN_HOURS:
+        bot.send_message(m.chat.id, f"Minimum interval is {SCHEDULE_MIN_HOURS:g} hours.")
+        return
+    if material_id is not None and get_material_text(uid, material_id) is None:
+        bot.send_message(m.chat.id, "Material not found.")
+        return
+    sid, next_ts = create_schedule(uid, material_id, int(hours * 3600))
+    what = "all saved texts" if material_id is None else f"material #{material_id}"
+    first = datetime.utcfromtimestamp(next_ts).strftime("%Y-%m-%d %H:%M")
+    bot.send_message(m.chat.id, f"⏰ Schedule #{sid}: {what} to your selected groups every {hours:g}h.\nFirst run (UTC): {first}\nCancel with /unschedule {sid}")
+
+@bot.message_handler(commands=["schedules"])
+def schedules_command(m):
+    rows = list_schedules(m.from_user.id)
+    if not rows:
+        bot.send_message(m.chat.id, "No scheduled promotions. Create one with /schedule <material_id|all> <hours>")
+        return
+    lines = []
+    for sid, material_id, interval, next_ts in rows:
+        what = "all texts" if material_id is None else f"#{material_id}"
+        lines.append(f"#{sid}: {what} every {interval / 3600:g}h, next {datetime.utcfromtimestamp(next_ts).strftime('%Y-%m-%d %H:%M')} UTC")
+    bot.send_message(m.chat.id, "⏰ Scheduled promotions:\n" + "\n".join(lines))
+
+@bot.message_handler(commands=["unschedule"])
+def unschedule_command(m):
+    parts = m.text.split()
+    if len(parts) != 2 or not parts[1].lstrip("#").isdigit():
+        bot.send_message(m.chat.id, "Usage: /unschedule <schedule_id>")
+        return
+    sid = int(parts[1].lstrip("#"))
+    if cancel_schedule(m.from_user.id, sid):
+        bot.send_message(m.chat.id, f"Schedule #{sid} cancelled.")
+    else:
+        bot.send_message(m.chat.id, "Schedule not found.")
 
-    elif data == "back_main":
-        bot.send_message(uid, "Back to main menu.", reply_markup=main_menu_kb())
-        bot.answer_callback_query(c.id)
+# ---------------- SUBSCRIPTION EXPIRY ----------------
+def expire_subscriptions(now=None, batch=EXPIRY_BATCH_SIZE):
+    """
+    Deactivate users whose plan expired, one UPDATE per batch (range scan on idx_users_active_expiry).
+    Returns the ids that were deactivated.
+    """
+    now = int(now or time.time())
+    expired = []
+    while True:
+        with transaction() as db:
+            ids = [r[0] for r in db.execute("SELECT user_id FROM users WHERE active=1 AND plan_expiry_ts <= ? LIMIT ?",
+                                            (now, batch)).fetchall()]
+            if ids:
+                marks = ",".join("?" * len(ids))
+                db.execute(f"UPDATE users SET active=0 WHERE user_id IN ({marks})", ids)
+        for uid in ids:
+            invalidate_user(uid)
+        expired.extend(ids)
+        if len(ids) < batch:
+            return expired
+
+def remind_expiring_subscriptions(now=None, days=EXPIRY_REMINDER_DAYS, batch=EXPIRY_BATCH_SIZE):
+    """
+    Send one "plan expiring" reminder to users whose plan ends within `days` days.
+    Users are marked before sending, so a crash never causes a second reminder.
+    """
+    if days <= 0:
+        return 0
+    now = int(now or time.time())
+    sent = 0
+    while True:
+        with transaction() as db:
+            rows = db.execute("SELECT user_id, plan_expiry FROM users WHERE active=1 AND plan_expiry_ts > ? AND plan_expiry_ts <= ? "
+                              "AND expiry_reminded=0 LIMIT ?", (now, now + days * 86400, batch)).fetchall()
+            if rows:
+                marks = ",".join("?" * len(rows))
+                db.execute(f"UPDATE users SET expiry_reminded=1 WHERE user_id IN ({marks})", [r[0] for r in rows])
+        for uid, expiry in rows:
+            invalidate_user(uid)
+            try:
+                send_rate_limited(uid, f"⏳ Your plan expires on <b>{expiry} UTC</b>. Contact {ADMIN_USERNAME} to renew.")
+                sent += 1
+            except Exception as e:
+                logging.info("Could not send expiry reminder to %s: %s", uid, e)
+        if len(rows) < batch:
+            return sent
+
+def expiry_scheduler():
+    while True:
+        if not sender_lease.held():
+            time.sleep(EXPIRY_SWEEP_INTERVAL)
+            continue
+        try:
+            expired = expire_subscriptions()
+            if expired:
+                logging.info("Deactivated %s expired subscription(s)", len(expired))
+            reminded = remind_expiring_subscriptions()
+            if reminded:
+                logging.info("Sent %s plan expiry reminder(s)", reminded)
+            step_store.purge()
+        except Exception as e:
+            logging.exception("expiry sweep failed: %s", e)
+        time.sleep(EXPIRY_SWEEP_INTERVAL)
 
+# ---------------- GROUP HEALTH ----------------
+group_sweep_bucket = TokenBucket(GROUP_SWEEP_RATE, 1)
+
+def check_group_status(chat_id):
+    """
+    'ok' (bot is admin), 'not_admin', 'dead' (bot kicked or chat gone), or None if Telegram could not tell us.
+    Refreshes the admin-status cache on the way.
+    """
+    try:
+        member = bot.get_chat_member(chat_id, get_bot_user().id)
+    except apihelper.ApiTelegramException as e:
+        # 400 chat not found / 403 bot kicked are definite; anything else (429, 5xx) is retried next sweep
+        if e.error_code not in (400, 403):
+            return None
+        status = "dead"
+    except Exception as e:
+        logging.debug("health check failed for %s: %s", chat_id, e)
+        return None
     else:
-        bot.answer_callback_query(c.id, text="Unknown callback.")
+        status = group_status_for(member.status)
+    admin_status_cache.set(chat_id, status == "ok")
+    return status
+
+def group_status_for(member_status):
+    if member_status in ("administrator", "creator"):
+        return "ok"
+    if member_status in ("left", "kicked"):
+        return "dead"
+    return "not_admin"
+
+def set_group_status(db, results, now):
+    """
+    Store (chat_id, status) results; status_since only moves when the status actually changes.
+    """
+    db.executemany("UPDATE groups SET status_since = CASE WHEN status IS ? THEN status_since ELSE ? END, "
+                   "status=?, last_verified_at=? WHERE chat_id=?",
+                   [(status, now, status, now, chat_id) for chat_id, status in results])
 
-# ---------------- PROMOTION WORKER ----------------
-def perform_promotion(user_id, group_ids, messages):
+def prune_dead_groups(now=None, after=GROUP_PRUNE_AFTER):
+    """
+    Delete groups that have been dead for `after` seconds (selections go with them). Returns their ids.
     """
-    For each group, check if bot is admin; if yes, send messages sequentially.
+    now = int(now or time.time())
+    with transaction() as db:
+        ids = [r[0] for r in db.execute("SELECT chat_id FROM groups WHERE status='dead' AND status_since <= ?",
+                                        (now - after,)).fetchall()]
+        db.execute("DELETE FROM groups WHERE status='dead' AND status_since <= ?", (now - after,))
+    return ids
+
+def sweep_groups(batch=GROUP_SWEEP_BATCH):
     """
-    total_groups = len(group_ids)
-    success_count = 0
-    fail_count = 0
+    Re-verify registered groups not verified within the last half sweep interval, GROUP_SWEEP_RATE
+    checks per second, one write transaction per batch. Returns {status: count} for what was checked.
+    """
+    counts = {}
+    after = -(1 << 63)
+    while True:
+        fresh = int(time.time() - GROUP_SWEEP_INTERVAL / 2)
+        rows = db_fetchall("SELECT chat_id FROM groups WHERE chat_id > ? AND COALESCE(last_verified_at, 0) < ? "
+                           "ORDER BY chat_id LIMIT ?", (after, fresh, batch))
+        if not rows:
+            return counts
+        after = rows[-1][0]
+        results = []
+        for (chat_id,) in rows:
+            group_sweep_bucket.acquire()
+            status = check_group_status(chat_id)
+            counts[status or "unknown"] = counts.get(status or "unknown", 0) + 1
+            if status:
+                results.append((chat_id, status))
+        with transaction() as db:
+            set_group_status(db, results, int(time.time()))
+
+def group_health_sweeper():
+    while True:
+        if not sender_lease.held():
+            time.sleep(SENDER_LEASE_TTL)
+            continue
+        try:
+            started = time.monotonic()
+            counts = sweep_groups()
+            pruned = prune_dead_groups()
+            if counts or pruned:
+                logging.info("Group sweep in %.0fs: %s; pruned %s dead group(s)", time.monotonic() - started, counts, len(pruned))
+        except Exception as e:
+            logging.exception("group sweep failed: %s", e)
+        time.sleep(GROUP_SWEEP_INTERVAL)
 
-    for gid in group_ids:
+# ---------------- BROADCASTS ----------------
+broadcast_wakeup = threading.Event()
+
+def set_user_blocked(uid, blocked):
+    db_execute("UPDATE users SET blocked_at=? WHERE user_id=?", (int(time.time()) if blocked else None, uid))
+
+def create_broadcast(text):
+    bid = db_execute("INSERT INTO broadcasts(text, status, created_at) VALUES(?, 'queued', ?)",
+                     (text, datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"))).lastrowid
+    broadcast_wakeup.set()
+    return bid
+
+def claim_broadcast():
+    """
+    Lease the oldest queued broadcast, or a running one whose lease expired (its process died).
+    Returns (id, text, cursor) or None.
+    """
+    now = int(time.time())
+    with transaction() as db:
+        row = db.execute("SELECT id, text, cursor FROM broadcasts WHERE status='queued' "
+                         "OR (status='running' AND COALESCE(lease_expires, 0) < ?) ORDER BY id LIMIT 1", (now,)).fetchone()
+        if row:
+            db.execute("UPDATE broadcasts SET status='running', lease_owner=?, lease_expires=? WHERE id=?",
+                       (worker_id(), now + JOB_LEASE_TTL, row[0]))
+    return row
+
+def save_broadcast_progress(bid, cursor, sent, failed, blocked_ids):
+    """
+    Advance the cursor and counters, renew the lease and mark blocked users in one commit.
+    False if the broadcast was cancelled or taken over by another process.
+    """
+    now = int(time.time())
+    with transaction() as db:
+        if blocked_ids:
+            marks = ",".join("?" * len(blocked_ids))
+            db.execute(f"UPDATE users SET blocked_at=? WHERE user_id IN ({marks})", [now, *blocked_ids])
+        return db.execute("UPDATE broadcasts SET cursor=?, sent=sent+?, failed=failed+?, blocked=blocked+?, lease_expires=? "
+                          "WHERE id=? AND status='running' AND lease_owner=?",
+                          (cursor, sent, failed, len(blocked_ids), now + JOB_LEASE_TTL, bid, worker_id())).rowcount == 1
+
+def broadcast_send(uid, text):
+    """
+    Send one broadcast message within the global send budget. Returns 'sent', 'blocked' (403) or 'failed'.
+    A private chat gets a single message, so no per-chat bucket is needed.
+    """
+    for attempt in range(API_MAX_RETRIES + 1):
+        global_send_bucket.acquire()
         try:
-            # verify the bot is admin
-            if not bot_is_admin_in(gid):
-                bot.send_message(user_id, f"Skipping {gid}: bot is not admin or cannot access the group.")
-                fail_count += 1
+            bot.send_message(uid, text)
+            return "sent"
+        except apihelper.ApiTelegramException as e:
+            code = api_error_code(e)
+            if code == 403:
+                return "blocked"
+            if code == 429 and attempt < API_MAX_RETRIES:
+                # _api_request already retried short waits; this one asked for longer
+                time.sleep(retry_after(e))
                 continue
+            logging.info("broadcast to %s failed: %s", uid, e)
+            return "failed"
+        except Exception as e:
+            logging.info("broadcast to %s failed: %s", uid, e)
+            return "failed"
+    return "failed"
 
-            # Attempt to send all messages
-            any_sent = False
-            for m in messages:
-                try:
-                    bot.send_message(gid, m)
-                    any_sent = True
-                    time.sleep(1)  # small delay to avoid flood
-                except Exception as e:
-                    logging.warning("Failed to send to %s: %s", gid, e)
-                    # if a message fails in this group, continue with next message
-                    continue
-
-            if any_sent:
-                success_count += 1
+def run_broadcast(bid, text, cursor):
+    """
+    Stream reachable users by keyset (user_id > cursor), BROADCAST_BATCH at a time, saving progress after each batch.
+    After a crash at most one batch is sent again.
+    """
+    logging.info("Broadcast #%s running from user_id > %s", bid, cursor)
+    while True:
+        uids = [r[0] for r in db_fetchall("SELECT user_id FROM users WHERE user_id > ? AND blocked_at IS NULL ORDER BY user_id LIMIT ?",
+                                          (cursor, BROADCAST_BATCH))]
+        if not uids:
+            break
+        sent = failed = 0
+        blocked = []
+        for uid in uids:
+            result = broadcast_send(uid, text)
+            metrics.inc("broadcast_messages_total", (("result", result),))
+            if result == "sent":
+                sent += 1
+            elif result == "blocked":
+                blocked.append(uid)
             else:
-                fail_count += 1
+                failed += 1
+        cursor = uids[-1]
+        if not save_broadcast_progress(bid, cursor, sent, failed, blocked):
+            logging.info("Broadcast #%s stopped (cancelled or taken over)", bid)
+            return
+    finished = db_execute("UPDATE broadcasts SET status='done', finished_at=?, lease_expires=NULL "
+                          "WHERE id=? AND status='running' AND lease_owner=?",
+                          (datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"), bid, worker_id())).rowcount
+    if finished:
+        sent, failed, blocked = db_fetchone("SELECT sent, failed, blocked FROM broadcasts WHERE id=?", (bid,))
+        logging.info("Broadcast #%s done: %s sent, %s failed, %s blocked", bid, sent, failed, blocked)
+        try:
+            bot.send_message(ADMIN_ID, f"📣 Broadcast #{bid} finished: {sent} sent, {failed} failed, {blocked} blocked the bot.")
+        except Exception as e:
+            logging.info("Could not report broadcast #%s: %s", bid, e)
 
+def broadcast_worker():
+    while True:
+        try:
+            job = claim_broadcast() if sender_lease.held() else None
+            if job is None:
+                broadcast_wakeup.wait(30)
+                broadcast_wakeup.clear()
+                continue
+            run_broadcast(*job)
         except Exception as e:
-            logging.exception("Error during promotion to %s: %s", gid, e)
-            fail_count += 1
+            logging.exception("broadcast worker failed: %s", e)
+            time.sleep(5)
+
+@bot.message_handler(commands=["broadcast"])
+def admin_broadcast(m):
+    if m.from_user.id != ADMIN_ID:
+        return
+    parts = m.text.split(maxsplit=1)
+    if len(parts) != 2:
+        bot.send_message(m.chat.id, "Usage: /broadcast <text>\nThe text is sent as HTML to every user who has not blocked the bot.")
+        return
+    text = parts[1]
+    # the admin gets the message first: broken HTML fails here instead of for every user
+    try:
+        bot.send_message(m.chat.id, text)
+    except apihelper.ApiTelegramException as e:
+        bot.send_message(m.chat.id, f"❌ Telegram rejected this text: {html.escape(e.description)}")
+        return
+    bid = create_broadcast(text)
+    recipients = db_fetchone("SELECT COUNT(*) FROM users WHERE blocked_at IS NULL")[0]
+    bot.send_message(m.chat.id, f"📣 Broadcast #{bid} queued for {recipients} users (preview above).\n"
+                                f"Progress: /broadcasts, cancel: /stopbroadcast {bid}")
+
+@bot.message_handler(commands=["broadcasts"])
+def admin_broadcasts(m):
+    if m.from_user.id != ADMIN_ID:
+        return
+    rows = db_fetchall("SELECT id, status, sent, failed, blocked, created_at FROM broadcasts ORDER BY id DESC LIMIT 10")
+    if not rows:
+        bot.send_message(m.chat.id, "No broadcasts yet.")
+        return
+    lines = [f"#{bid} [{status}] {sent} sent, {failed} failed, {blocked} blocked - {created_at}"
+             for bid, status, sent, failed, blocked, created_at in rows]
+    bot.send_message(m.chat.id, "Broadcasts:\n" + "\n".join(lines))
 
-    bot.send_message(user_id, f"Promotion finished.\nSuccessful groups: {success_count}\nFailed/Skipped groups: {fail_count}\nTotal attempted: {total_groups}")
+@bot.message_handler(commands=["stopbroadcast"])
+def admin_stop_broadcast(m):
+    if m.from_user.id != ADMIN_ID:
+        return
+    parts = m.text.split()
+    if len(parts) != 2 or not parts[1].isdigit():
+        bot.send_message(m.chat.id, "Usage: /stopbroadcast <id>")
+        return
+    stopped = db_execute("UPDATE broadcasts SET status='cancelled', finished_at=? WHERE id=? AND status IN ('queued', 'running')",
+                         (datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"), int(parts[1]))).rowcount
+    bot.send_message(m.chat.id, f"Broadcast #{parts[1]} cancelled." if stopped else "No queued or running broadcast with that id.")
 
 # ---------------- ADMIN COMMANDS ----------------
 @bot.message_handler(commands=["active"])
@@ -565,11 +2952,9 @@ def admin_activate(m):
         if code not in plans:
             bot.send_message(m.chat.id, "Invalid plan code.")
             return
-        expiry = datetime.utcnow() + timedelta(days=plans[code])
-        expiry_str = expiry.strftime("%Y-%m-%d %H:%M:%S")
-        update_user(uid, "active", 1)
-        update_user(uid, "plan", code)
-        update_user(uid, "plan_expiry", expiry_str)
+        expiry_ts = int(time.time()) + plans[code] * 86400
+        expiry_str = datetime.utcfromtimestamp(expiry_ts).strftime("%Y-%m-%d %H:%M:%S")
+        update_user(uid, active=1, plan=code, plan_expiry=expiry_str, plan_expiry_ts=expiry_ts, expiry_reminded=0)
         bot.send_message(m.chat.id, f"Activated {uid}\nPlan: {code}\nExpiry (UTC): {expiry_str}")
     except Exception as e:
         bot.send_message(m.chat.id, f"Error: {e}")
@@ -578,13 +2963,27 @@ def admin_activate(m):
 def admin_stats(m):
     if m.from_user.id != ADMIN_ID:
         return
-    cur.execute("SELECT COUNT(*) FROM users")
-    total_users = cur.fetchone()[0]
-    cur.execute("SELECT COUNT(*) FROM users WHERE active=1")
-    active_users = cur.fetchone()[0]
-    cur.execute("SELECT COUNT(*) FROM groups")
-    total_groups = cur.fetchone()[0]
-    bot.send_message(m.chat.id, f"Users total: {total_users}\nActive users: {active_users}\nRegistered groups: {total_groups}")
+    total_users, active_users, total_groups, flagged = db_fetchone(
+        "SELECT (SELECT COUNT(*) FROM users), (SELECT COUNT(*) FROM users WHERE active=1), (SELECT COUNT(*) FROM groups), "
+        "(SELECT COUNT(*) FROM groups WHERE status != 'ok')")
+    uc = user_cache.stats()
+    bot.send_message(m.chat.id, f"Users total: {total_users}\nActive users: {active_users}\n"
+                                f"Registered groups: {total_groups} ({flagged} flagged)\n"
+                                f"User cache: {uc['size']}/{uc['max_size']} entries, {uc['hits']} hits, {uc['misses']} misses")
+
+@bot.message_handler(commands=["jobs"])
+def admin_jobs(m):
+    if m.from_user.id != ADMIN_ID:
+        return
+    rows = list_promotion_jobs()
+    if not rows:
+        bot.send_message(m.chat.id, "No promotion jobs yet.")
+        return
+    lines = []
+    for job_id, user_id, status, total, sent, failed, created_at in rows:
+        pct = int((sent + failed) * 100 / total) if total else 100
+        lines.append(f"#{job_id} [{status}] user {user_id}: {sent} sent, {failed} failed of {total} ({pct}%) - {created_at}")
+    bot.send_message(m.chat.id, "Promotion jobs:\n" + "\n".join(lines))
 
 # register_group should be run inside the group to register it safely
 @bot.message_handler(commands=["register_group"])
@@ -595,10 +2994,12 @@ def register_group(m):
         bot.reply_to(m, "This command must be run inside the group you want to register.")
         return
 
-    # check bot admin status
+    # check bot admin status (always ask Telegram here, the user may have just promoted the bot)
     try:
-        member = bot.get_chat_member(chat.id, bot.get_me().id)
-        if member.status not in ("administrator", "creator"):
+        member = bot.get_chat_member(chat.id, get_bot_user().id)
+        is_admin = member.status in ("administrator", "creator")
+        admin_status_cache.set(chat.id, is_admin)
+        if not is_admin:
             bot.reply_to(m, "Bot is not an administrator in this group. Make the bot admin and then run /register_group again.")
             return
     except Exception as e:
@@ -651,16 +3052,65 @@ def remove_group_command(m):
     except:
         bot.reply_to(m, "Invalid chat id.")
 
+# ---------------- CHAT MEMBER UPDATES ----------------
+@bot.my_chat_member_handler()
+def bot_membership_changed(update):
+    """
+    Telegram tells us when the bot is promoted, demoted, kicked or added: refresh the admin cache right away.
+    """
+    status = update.new_chat_member.status
+    admin_status_cache.set(update.chat.id, status in ("administrator", "creator"))
+    if update.chat.type in ("group", "supergroup", "channel"):
+        with transaction() as db:
+            set_group_status(db, [(update.chat.id, group_status_for(status))], int(time.time()))
+    elif update.chat.type == "private":
+        # the user blocked ("kicked") or restarted the bot
+        set_user_blocked(update.chat.id, status == "kicked")
+    if status not in ("left", "kicked"):
+        chat_breaker.reset(update.chat.id)
+    logging.info("Bot status in %s changed: %s -> %s", update.chat.id, update.old_chat_member.status, status)
+
 # ---------------- SAVE TEXT HANDLER ----------------
+def save_material_within_quota(uid, text):
+    """
+    save_material unless the user already has MATERIAL_QUOTA texts. Returns their new total, or None if over quota.
+    The count and the insert share one BEGIN IMMEDIATE, so concurrent saves can't both slip under the quota.
+    """
+    with transaction():
+        if MATERIAL_QUOTA and count_materials(uid) >= MATERIAL_QUOTA:
+            metrics.inc("material_quota_rejections_total")
+            return None
+        save_material(uid, text)
+        return count_materials(uid)
+
+def quota_reached_text():
+    return f"❌ You have reached the limit of {MATERIAL_QUOTA} saved texts. Delete some in 📝 Materials first."
+
+@step_handler("save_text")
 def handle_save_text(m):
     txt = m.text.strip() if m.text else ""
     if not txt:
         bot.send_message(m.chat.id, "Empty text. Cancelled.")
         return
-    save_material(m.from_user.id, txt)
-    total = len(get_materials(m.from_user.id))
+    total = save_material_within_quota(m.from_user.id, txt)
+    if total is None:
+        bot.send_message(m.chat.id, quota_reached_text())
+        return
     bot.send_message(m.chat.id, f"Saved! Total saved texts: {total}")
 
+@step_handler("group_search")
+def handle_group_search(m):
+    query = m.text.strip()[:64] if m.text else ""
+    if not query or query.startswith("/"):
+        bot.send_message(m.chat.id, "Empty search. Cancelled.")
+        return
+    set_group_search(m.from_user.id, query)
+    page = groups_page(m.from_user.id)
+    if not page:
+        bot.send_message(m.chat.id, "No groups registered yet.")
+        return
+    bot.send_message(m.chat.id, page[0], reply_markup=page[1])
+
 # ---------------- CATCH-ALL FOR RAW TEXT (saving) ----------------
 @bot.message_handler(func=lambda m: True, content_types=["text"])
 def catch_all_save(m):
@@ -669,20 +3119,280 @@ def catch_all_save(m):
     if m.text in menu_texts or m.text.startswith("/"):
         return
     # Save as material automatically
-    save_material(m.from_user.id, m.text)
-    bot.reply_to(m, f"Saved automatically! Total saved texts: {len(get_materials(m.from_user.id))}")
+    total = save_material_within_quota(m.from_user.id, m.text)
+    if total is None:
+        bot.reply_to(m, quota_reached_text())
+        return
+    bot.reply_to(m, f"Saved automatically! Total saved texts: {total}")
+
+# ---------------- UPDATE QUEUE ----------------
+def update_chat_id(update):
+    """
+    Chat an update belongs to; updates of one chat are handled in arrival order.
+    """
+    for obj in (update.message, update.edited_message, update.channel_post, update.my_chat_member, update.chat_member):
+        if obj is not None:
+            return obj.chat.id
+    if update.callback_query is not None:
+        return update.callback_query.from_user.id
+    return update.update_id
+
+
+class UpdateQueue:
+    """
+    Webhook updates sharded over `workers` threads by chat id: one chat always lands on the
+    same worker (ordered), different chats are handled in parallel.
+    """
+    def __init__(self, workers, maxsize):
+        self.queues = [queue.Queue(maxsize) for _ in range(max(1, workers))]
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.dropped = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.busy_since = {}
+
+    def put(self, update):
+        """
+        Returns False if the shard is full (the caller should make Telegram retry later).
+        """
+        q = self.queues[update_chat_id(update) % len(self.queues)]
+        try:
+            q.put_nowait((time.monotonic(), update))
+            return True
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            return False
+
+    def _work(self, idx):
+        q = self.queues[idx]
+        while True:
+            enqueued, update = q.get()
+            started = time.monotonic()
+            metrics.observe("update_queue_lag_seconds", (), started - enqueued)
+            with self.lock:
+                self.last_lag = started - enqueued
+                self.max_lag = max(self.max_lag, self.last_lag)
+                self.busy_since[idx] = started
+            try:
+                bot.process_new_updates([update])
+            except Exception as e:
+                logging.exception("update %s failed: %s", update.update_id, e)
+            finally:
+                with self.lock:
+                    self.processed += 1
+                    self.busy_since.pop(idx, None)
+                q.task_done()
+
+    def start(self):
+        for idx in range(len(self.queues)):
+            threading.Thread(target=self._work, args=(idx,), daemon=True).start()
+
+    def stats(self):
+        now = time.monotonic()
+        with self.lock:
+            oldest = min(self.busy_since.values(), default=None)
+            return {
+                'queue_depth': sum(q.qsize() for q in self.queues),
+                'workers': len(self.queues),
+                'processed': self.processed,
+                'rejected_full': self.dropped,
+                'handler_lag_ms': round(self.last_lag * 1000, 1),
+                'handler_lag_max_ms': round(self.max_lag * 1000, 1),
+                'longest_running_ms': round((now - oldest) * 1000, 1) if oldest else 0,
+            }
+
+
+class UpdateDeduplicator:
+    """
+    Drops webhook redeliveries. Remembers the last `window` update_ids in memory and, if
+    `persist` is set, the highest enqueued id in bot_state (with the time it was stored), so
+    redeliveries from just before a restart are recognised too. The stored mark only covers ids
+    in (mark - window, mark] and is ignored once older than UPDATE_ID_RESET_AGE: after a week
+    without updates Telegram starts update_ids again from a random value.
+    """
+    def __init__(self, window, persist):
+        self.window = window
+        self.persist = persist
+        self.seen = set()
+        self.order = deque()
+        self.retry = set()  # answered 503, Telegram will send them again
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.floor = None
+        self.high = 0
+        self.stored = 0
+        if persist:
+            self.floor = self._load_floor()
+            self.high = self.stored = self.floor or 0
+
+    def _load_floor(self):
+        stored = get_state("last_update_id")
+        if not stored:
+            return None
+        mark, _, stored_at = stored.partition(" ")
+        if not stored_at or time.time() - float(stored_at) > UPDATE_ID_RESET_AGE:
+            logging.info("Stored update_id %s is too old to trust (Telegram may have reset ids), ignoring it", mark)
+            return None
+        return int(mark)
+
+    def accept(self, update_id):
+        """
+        True the first time an update_id is seen, False for duplicates.
+        """
+        with self.lock:
+            if update_id in self.seen or (self.floor is not None and self.floor - self.window < update_id <= self.floor):
+                self.dropped += 1
+                return False
+            self.seen.add(update_id)
+            self.order.append(update_id)
+            if len(self.order) > self.window:
+                self.seen.discard(self.order.popleft())
+            self.retry.discard(update_id)
+            return True
+
+    def mark(self, update_id):
+        """
+        Record an update that made it into the queue; flush() stores the highest one.
+        """
+        with self.lock:
+            self.high = max(self.high, update_id)
+
+    def forget(self, update_id):
+        """
+        Undo accept() for an update we could not take (so Telegram's retry is not dropped).
+        """
+        with self.lock:
+            self.seen.discard(update_id)
+            if len(self.retry) < self.window:
+                self.retry.add(update_id)
+
+    def discard(self, update_id):
+        """
+        Stop waiting for the retry of an update we answered OK without queueing (e.g. throttled).
+        """
+        with self.lock:
+            self.retry.discard(update_id)
+
+    def flush(self):
+        """
+        Store the highest enqueued update_id, kept below any id still waiting for Telegram's retry.
+        """
+        with self.lock:
+            mark = min(self.high, min(self.retry, default=self.high + 1) - 1)
+        if mark <= self.stored:
+            return
+        # MAX() so processes sharing the database can't move the mark backwards
+        db_execute("INSERT INTO bot_state(key, value) VALUES('last_update_id', ? || ' ' || ?) "
+                   "ON CONFLICT(key) DO UPDATE SET value=MAX(CAST(value AS INTEGER), CAST(excluded.value AS INTEGER)) || ' ' || ?",
+                   (mark, int(time.time()), int(time.time())))
+        self.stored = mark
+
+    def flusher(self):
+        while True:
+            time.sleep(UPDATE_DEDUP_FLUSH)
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                logging.warning("could not store last update_id: %s", e)
+
+
+class IngressLimiter:
+    """
+    Per-user token buckets checked in the webhook before an update is deduplicated or queued.
+    Over-limit messages are acknowledged and dropped, so they never cost a SQLite write or a reply.
+    Callback queries and the admin are not limited.
+    """
+    def __init__(self, rate, burst, maxsize):
+        self.limiter = ChatRateLimiter(rate, burst, maxsize)
+        self.maxsize = maxsize
+        self.throttled = OrderedDict()  # user_id -> when last throttled (monotonic)
+        self.lock = threading.Lock()
+        self.dropped = 0
+
+    def admit(self, update):
+        msg = update.message or update.edited_message
+        if msg is None or msg.from_user is None or msg.from_user.id == ADMIN_ID:
+            return True
+        uid = msg.from_user.id
+        if not self.limiter.try_acquire(uid):
+            return True
+        with self.lock:
+            self.dropped += 1
+            self.throttled[uid] = time.monotonic()
+            self.throttled.move_to_end(uid)
+            if len(self.throttled) > self.maxsize:
+                self.throttled.popitem(last=False)
+        metrics.inc("ingress_throttled_total")
+        return False
+
+    def throttled_users(self, window=60):
+        """
+        Users that hit their limit in the last `window` seconds.
+        """
+        since = time.monotonic() - window
+        with self.lock:
+            return sum(1 for t in self.throttled.values() if t >= since)
+
+    def stats(self):
+        return {'dropped': self.dropped, 'throttled_users_1m': self.throttled_users()}
+
+
+update_queue = UpdateQueue(UPDATE_WORKERS, UPDATE_QUEUE_SIZE)
+ingress_limiter = IngressLimiter(USER_MSG_RATE, USER_MSG_BURST, USER_LIMITER_SIZE)
+update_dedup = UpdateDeduplicator(UPDATE_DEDUP_WINDOW, UPDATE_DEDUP_PERSIST)
 
 # ---------------- WEBHOOK ENDPOINTS ----------------
 @app.route(WEBHOOK_URL_PATH, methods=['POST'])
 def webhook():
     if request.headers.get('content-type') == 'application/json':
-        json_string = request.get_data().decode('utf-8')
-        update = types.Update.de_json(json_string)
-        bot.process_new_updates([update])
-        return 'OK'
+        with metrics.timer("webhook_request_seconds"):
+            json_string = request.get_data().decode('utf-8')
+            update = types.Update.de_json(json_string)
+            if not ingress_limiter.admit(update):
+                update_dedup.discard(update.update_id)
+                return 'OK'
+            if not update_dedup.accept(update.update_id):
+                return 'OK'
+            if not update_queue.put(update):
+                # backpressure: a non-2xx answer makes Telegram redeliver the update later
+                update_dedup.forget(update.update_id)
+                return 'busy', 503
+            update_dedup.mark(update.update_id)
+            return 'OK'
     else:
         abort(403)
 
+def webhook_max_connections():
+    """
+    Concurrent POSTs Telegram may open to us: a few per update worker so the queue stays fed (Telegram allows 1-100).
+    Both modes handle updates on the UPDATE_WORKERS threads.
+    """
+    if WEBHOOK_MAX_CONNECTIONS:
+        return WEBHOOK_MAX_CONNECTIONS
+    return max(1, min(100, UPDATE_WORKERS * 4))
+
+def register_webhook():
+    # setWebhook replaces the old registration in place; pending updates are kept for us
+    return bot.set_webhook(url=WEBHOOK_URL, max_connections=webhook_max_connections(), drop_pending_updates=False)
+
+def ensure_webhook():
+    """
+    Compare getWebhookInfo with our settings and call setWebhook only if they differ.
+    Returns True if the webhook was (re-)registered.
+    """
+    info = bot.get_webhook_info()
+    if info.url == WEBHOOK_URL and info.max_connections == webhook_max_connections():
+        logging.info("✅ Webhook already registered (%s pending updates)", info.pending_update_count)
+        return False
+    if info.last_error_message:
+        logging.warning("Previous webhook error: %s", info.last_error_message)
+    register_webhook()
+    logging.info("✅ Webhook registered (max_connections=%s, %s pending updates kept)",
+                 webhook_max_connections(), info.pending_update_count)
+    return True
+
 @app.route('/')
 def index():
     return '🤖 Bot is running on Render!<br><a href="/set_webhook">Set Webhook</a> | <a href="/remove_webhook">Remove Webhook</a>'
@@ -690,12 +3400,7 @@ def index():
 @app.route('/set_webhook', methods=['GET'])
 def set_webhook():
     try:
-        # Remove existing webhook
-        bot.remove_webhook()
-        time.sleep(1)
-        
-        # Set new webhook
-        webhook_set = bot.set_webhook(url=WEBHOOK_URL)
+        webhook_set = register_webhook()
         
         if webhook_set:
             return f"""
@@ -744,7 +3449,268 @@ def remove_webhook():
 # ---------------- HEALTH CHECK ----------------
 @app.route('/health', methods=['GET'])
 def health_check():
-    return {'status': 'healthy', 'service': 'telegram-bot', 'timestamp': datetime.utcnow().isoformat()}
+    return {'status': 'healthy', 'service': 'telegram-bot', 'timestamp': datetime.utcnow().isoformat(),
+            'updates': dict(update_queue.stats(), duplicates_dropped=update_dedup.dropped),
+            'background_senders': sender_lease.held(),
+            'ingress': ingress_limiter.stats(),
+            'callbacks': callbacks.stats(),
+            'caches': {'users': user_cache.stats(), 'admin_status': admin_status_cache.stats(),
+                       'material_texts': material_text_cache.stats()}}
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+metrics.gauge("update_queue_depth", "Updates waiting for a handler worker",
+              lambda: {(): update_queue.stats()['queue_depth']})
+metrics.gauge("updates_rejected_total", "Updates answered with 503 because the queue was full",
+              lambda: {(): update_queue.dropped}, kind="counter")
+metrics.gauge("updates_duplicate_total", "Redelivered updates dropped by the deduplicator",
+              lambda: {(): update_dedup.dropped}, kind="counter")
+metrics.gauge("ingress_throttled_users", "Users throttled by the ingress limiter in the last minute",
+              lambda: {(): ingress_limiter.throttled_users()})
+metrics.gauge("promotion_jobs", "Promotion jobs by status",
+              lambda: {(("status", st),): n for st, n in db_fetchall("SELECT status, COUNT(*) FROM promotion_jobs GROUP BY status")})
+metrics.gauge("cache_hits_total", "Cache hits",
+              lambda: {(("cache", name),): c.hits for name, c in (("users", user_cache), ("admin_status", admin_status_cache))},
+              kind="counter")
+metrics.gauge("cache_misses_total", "Cache misses",
+              lambda: {(("cache", name),): c.misses for name, c in (("users", user_cache), ("admin_status", admin_status_cache))},
+              kind="counter")
+
+# ---------------- ASYNC RUNTIME ----------------
+# ASYNC_MODE=1: aiohttp serves the webhook and promotion jobs run as asyncio tasks on AsyncTeleBot, so
+# the sends of a bulk promotion share one event loop instead of a thread each. That is all this mode
+# makes asynchronous: message and callback handlers are NOT coroutines. They are the synchronous ones
+# above, running on the UPDATE_WORKERS sharded threads (which keep per-chat order), so the number of
+# updates handled at once is bounded by thread count exactly as in the Flask mode.
+abot = None
+async_send_slots = None
+db_executor = None
+
+async def run_blocking(fn, *args):
+    """
+    Run a blocking call (SQLite, sync Bot API) on the executor; every executor thread has its own connection.
+    """
+    return await asyncio.get_running_loop().run_in_executor(db_executor, functools.partial(fn, *args))
+
+async def async_send_message(chat_id, text, **kwargs):
+    """
+    abot.send_message with the breaker, retries and metrics _api_request gives the sync bot.
+    """
+    labels = (("method", "sendMessage"),)
+    if not chat_breaker.allow(chat_id):
+        metrics.inc("telegram_api_errors_total", labels + (("code", "circuit_open"),))
+        raise ChatUnavailable("sendMessage", chat_id)
+    attempt = 0
+    while True:
+        started = time.perf_counter()
+        try:
+            async with async_send_slots:
+                result = await abot.send_message(chat_id, text, **kwargs)
+        except Exception as e:
+            code = api_error_code(e)
+            metrics.inc("telegram_api_errors_total", labels + (("code", code),))
+            if code == 403:
+                chat_breaker.trip(chat_id)
+            wait = api_retry_delay(e, attempt)
+            if wait is None:
+                raise
+        else:
+            chat_breaker.reset(chat_id)
+            return result
+        finally:
+            metrics.observe("telegram_api_seconds", labels, time.perf_counter() - started)
+        attempt += 1
+        metrics.inc("telegram_api_retries_total", labels)
+        await asyncio.sleep(wait)
+
+
+class AsyncPromotionDispatcher(PromotionDispatcher):
+    """
+    PromotionDispatcher on the event loop: one task per group instead of worker threads sharing a heap.
+    Sends go through async_send_message (bounded by async_send_slots), checkpoints run on the executor.
+    """
+    async def _step_async(self, seq, gid, idx):
+        if gid not in self.verified:
+            try:
+                is_admin = await run_blocking(bot_is_admin_in, gid)
+            except apihelper.ApiTelegramException as e:
+                return await run_blocking(self._send_failed, seq, gid, idx, e)
+            if not is_admin:
+                self.skipped.append(gid)
+                await run_blocking(self._fail_rest, gid, idx, "skipped")
+                return None
+            self.verified.add(gid)
+
+        wait = chat_send_limiter.try_acquire(gid)
+        if wait:
+            return (time.monotonic() + wait, seq, gid, idx)
+        while True:
+            wait = global_send_bucket.try_acquire()
+            if not wait:
+                break
+            await asyncio.sleep(wait)
+
+        await run_blocking(self._mark, gid, idx, "pending")
+        try:
+            await async_send_message(gid, self.messages[idx])
+        except Exception as e:
+            return await run_blocking(self._send_failed, seq, gid, idx, e)
+        return await run_blocking(self._send_ok, seq, gid, idx)
+
+    async def _group(self, item):
+        while item and not self.stopped:
+            delay = item[0] - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            _, seq, gid, idx = item
+            try:
+                item = await self._step_async(seq, gid, idx)
+            except Exception as e:
+                logging.exception("Error during promotion to %s: %s", gid, e)
+                await run_blocking(self._fail_rest, gid, idx, "failed")
+                item = None
+            await self._report_async()
+
+    async def _report_async(self):
+        if self.status_msg_id is None or time.monotonic() - self.last_report < PROGRESS_INTERVAL:
+            return
+        self.last_report = time.monotonic()
+        try:
+            await abot.edit_message_text(self._progress_text(), self.user_id, self.status_msg_id)
+        except Exception as e:
+            logging.debug("progress update failed for %s: %s", self.user_id, e)
+
+    async def run_async(self):
+        self.started = self.last_report = time.monotonic()
+        if not self.total:
+            return
+        self.resumed = self.done
+        try:
+            self.status_msg_id = (await abot.send_message(self.user_id, self._progress_text())).message_id
+        except Exception as e:
+            logging.info("Could not send progress message to %s: %s", self.user_id, e)
+        await asyncio.gather(*(self._group(item) for item in self.ready))
+        if not self.stopped:
+            await abot.send_message(self.user_id, self._summary_text())
+
+
+async def run_promotion_job_async(job_id, user_id, group_ids, messages):
+    delivered = await run_blocking(get_job_deliveries, job_id)
+    if delivered:
+        logging.info("Resuming promotion job #%s (%s deliveries already done)", job_id, len(delivered))
+    dispatcher = AsyncPromotionDispatcher(user_id, group_ids, messages, delivered=delivered,
+                                          checkpoint=lambda gid, idx, status: checkpoint_delivery(job_id, gid, idx, status))
+    done = threading.Event()
+    asyncio.get_running_loop().run_in_executor(None, keep_job_lease, job_id, dispatcher, done)
+    try:
+        await dispatcher.run_async()
+        if not dispatcher.stopped:
+            await run_blocking(finish_promotion_job, job_id, "done")
+    except Exception as e:
+        logging.exception("promotion job #%s failed: %s", job_id, e)
+        await run_blocking(finish_promotion_job, job_id, "failed")
+    finally:
+        done.set()
+
+async def promotion_job_worker_async():
+    loop = asyncio.get_running_loop()
+    while True:
+        job = await run_blocking(claim_promotion_job) if sender_lease.held() else None
+        if job is None:
+            # jobs_wakeup is a threading.Event: wait for it off the loop
+            await loop.run_in_executor(None, jobs_wakeup.wait, 5)
+            jobs_wakeup.clear()
+            continue
+        await run_promotion_job_async(*job)
+
+async def async_webhook(req):
+    if req.content_type != 'application/json':
+        raise web.HTTPForbidden()
+    with metrics.timer("webhook_request_seconds"):
+        update = types.Update.de_json(await req.text())
+        if not ingress_limiter.admit(update):
+            update_dedup.discard(update.update_id)
+            return web.Response(text='OK')
+        if not update_dedup.accept(update.update_id):
+            return web.Response(text='OK')
+        if not update_queue.put(update):
+            update_dedup.forget(update.update_id)
+            return web.Response(text='busy', status=503)
+        update_dedup.mark(update.update_id)
+        return web.Response(text='OK')
+
+async def async_health(req):
+    return web.json_response(await run_blocking(health_check))
+
+async def async_metrics(req):
+    return web.Response(text=await run_blocking(metrics.render), content_type='text/plain')
+
+def create_async_app():
+    """
+    aiohttp application for ASYNC_MODE: webhook, /health and /metrics, with the async job workers.
+    """
+    global abot, db_executor
+    if web is None:
+        raise RuntimeError("ASYNC_MODE=1 needs aiohttp (pip install aiohttp)")
+    asyncio_helper.REQUEST_LIMIT = ASYNC_SEND_CONCURRENCY  # aiohttp connector size
+    abot = AsyncTeleBot(BOT_TOKEN, parse_mode="HTML")
+    db_executor = ThreadPoolExecutor(ASYNC_DB_WORKERS, thread_name_prefix="db")
+
+    async def on_startup(aio):
+        global async_send_slots
+        async_send_slots = asyncio.Semaphore(ASYNC_SEND_CONCURRENCY)
+        start_background_workers()
+        await run_blocking(recover_promotion_jobs)
+        aio['job_workers'] = [asyncio.create_task(promotion_job_worker_async()) for _ in range(PROMOTION_JOB_WORKERS)]
+
+    async def on_cleanup(aio):
+        for task in aio['job_workers']:
+            task.cancel()
+        await abot.close_session()
+
+    aio = web.Application()
+    aio.router.add_post(WEBHOOK_URL_PATH, async_webhook)
+    aio.router.add_get('/health', async_health)
+    aio.router.add_get('/metrics', async_metrics)
+    aio.on_startup.append(on_startup)
+    aio.on_cleanup.append(on_cleanup)
+    return aio
+
+# ---------------- BACKGROUND WORKERS ----------------
+instrument_handlers()  # after every handler is registered
+
+_workers_pid = None
+_workers_lock = threading.Lock()
+
+def start_background_workers():
+    """
+    Start this process's worker threads, once per process. Never called at import: with gunicorn --preload
+    the master imports the module and would fork with live threads and held locks. Started instead by
+    gunicorn's post_fork hook (gunicorn.conf.py), on a worker's first request, by aiohttp's on_startup and by __main__.
+    """
+    global _workers_pid
+    if _workers_pid == os.getpid():
+        return
+    with _workers_lock:
+        if _workers_pid == os.getpid():
+            return
+        threading.Thread(target=sender_lease.run, daemon=True).start()
+        if not ASYNC_MODE:
+            start_promotion_job_workers()  # async mode runs the job workers on the event loop instead
+        update_queue.start()
+        if UPDATE_DEDUP_PERSIST:
+            threading.Thread(target=update_dedup.flusher, daemon=True).start()
+        threading.Thread(target=expiry_scheduler, daemon=True).start()
+        threading.Thread(target=promotion_scheduler.run, daemon=True).start()
+        threading.Thread(target=group_health_sweeper, daemon=True).start()
+        threading.Thread(target=broadcast_worker, daemon=True).start()
+        _workers_pid = os.getpid()
+
+@app.before_request
+def ensure_background_workers():
+    start_background_workers()
 
 # ---------------- START WEBHOOK ----------------
 if __name__ == "__main__":
@@ -753,18 +3719,22 @@ if __name__ == "__main__":
     logging.info(f"🔧 Port: {PORT}")
     logging.info(f"🌐 External Hostname: {RENDER_EXTERNAL_HOSTNAME}")
     
-    # Try to set webhook automatically on startup
+    # Register the webhook only if Telegram's copy differs: no remove/sleep window, no dropped updates
+    started = time.perf_counter()
     try:
         if RENDER_EXTERNAL_HOSTNAME:
-            logging.info("🔄 Auto-setting webhook...")
-            bot.remove_webhook()
-            time.sleep(2)
-            bot.set_webhook(url=WEBHOOK_URL)
-            logging.info("✅ Webhook set automatically")
+            ensure_webhook()
         else:
             logging.warning("⚠️ No external hostname detected. Webhook not set automatically.")
     except Exception as e:
         logging.error(f"❌ Failed to auto-set webhook: {e}")
-    
-    # Start Flask app on Render's provided port
-    app.run(host='0.0.0.0', port=PORT)
+    logging.info("⏱️ Startup took %.0f ms (webhook check %.0f ms)", (time.perf_counter() - BOOT_STARTED) * 1000,
+                 (time.perf_counter() - started) * 1000)
+    start_background_workers()
+
+    if ASYNC_MODE:
+        logging.info("⚡ Async mode: aiohttp webhook, promotion sends on the event loop, handlers on %s update workers", UPDATE_WORKERS)
+        web.run_app(create_async_app(), host='0.0.0.0', port=PORT)
+    else:
+        # Start Flask app on Render's provided port
+        app.run(host='0.0.0.0', port=PORT)